@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Extract the fields used by other scripts from pages of annotations.
+
+Pages are parsed as they arrive and only the extracted scalar fields are
+appended to column buffers, so the nested annotation objects are never kept
+beyond the page being parsed.
+
+Once loaded, the columns of repeated strings, such as tags and manifest URIs,
+are stored as categoricals and task IDs as the smallest integer type that
+holds them (see `compact_df`).
+"""
+import pandas
+
+from helpers import get_tag, get_transcription, get_source, get_task_id
+from helpers import get_fragment_selector, get_lark
+
+
+# Increment when the extracted fields or their types change
+FORMAT_VERSION = 2
+
+COLUMNS = [
+    'id',
+    'created',
+    'modified',
+    'motivation',
+    'tag',
+    'transcription',
+    'source',
+    'selector',
+    'task_id',
+    'partOf',
+    'lark'
+]
+
+# Columns with few distinct values, stored as categoricals
+CATEGORY_COLUMNS = ['motivation', 'tag', 'source', 'partOf', 'lark']
+
+SELECTOR_PATTERN = (r'^(?P<x>-?[\d.]+),(?P<y>-?[\d.]+),'
+                    r'(?P<w>-?[\d.]+),(?P<h>-?[\d.]+)$')
+
+
+def extract_fields(anno):
+    """Return the fields of an annotation, in the order of COLUMNS."""
+    body = anno.get('body', [])
+    target = anno.get('target')
+    part_of = anno.get('partOf')
+    return (
+        anno.get('id'),
+        anno.get('created'),
+        anno.get('modified'),
+        anno.get('motivation'),
+        get_tag(body),
+        get_transcription(body),
+        get_source(target),
+        get_fragment_selector(target),
+        get_task_id(anno.get('generator', [])),
+        part_of,
+        get_lark(part_of)
+    )
+
+
+class ColumnBuffers(object):
+    """Accumulate the extracted fields of annotations column by column."""
+
+    def __init__(self):
+        self.columns = dict((col, []) for col in COLUMNS)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def extend(self, items):
+        """Extract the fields from a page of annotations and append them."""
+        rows = [extract_fields(anno) for anno in items]
+        for col, values in zip(COLUMNS, zip(*rows)):
+            self.columns[col].extend(values)
+
+    def to_df(self):
+        """Return the buffered columns as a dataframe.
+
+        Task IDs are cast to integers here, once for the whole collection,
+        using the nullable integer type so that missing IDs stay missing.
+        """
+        df = pandas.DataFrame(self.columns, columns=COLUMNS)
+        df['task_id'] = pandas.to_numeric(df['task_id']).astype('Int64')
+        return df
+
+
+def compact_df(df):
+    """Return the annotations with repeated strings stored as categoricals.
+
+    Task IDs are downcast to the smallest integer type, unless any are
+    missing. Columns not loaded are ignored.
+    """
+    df = df.copy()
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and df[col].dtype.name != 'category':
+            df[col] = df[col].astype('category')
+    if 'task_id' in df.columns:
+        if df['task_id'].isnull().any():
+            df['task_id'] = df['task_id'].astype('Int64')
+        else:
+            df['task_id'] = pandas.to_numeric(
+                df['task_id'].astype('int64'), downcast='integer')
+    return df
+
+
+def get_selector_coords(selectors):
+    """Return a dataframe of the x, y, w and h of fragment selectors.
+
+    Each distinct selector is parsed once. The coordinates are the smallest
+    integer type that holds them, unless any are fractional or missing.
+    """
+    codes, uniques = pandas.factorize(selectors)
+    coords_df = pandas.Series(uniques, dtype=object).str.extract(
+        SELECTOR_PATTERN, expand=True).astype(float)
+    coords_df = coords_df.reindex(codes)
+    coords_df.index = selectors.index
+    if coords_df.notnull().values.all() and \
+            (coords_df % 1 == 0).values.all():
+        coords_df = coords_df.apply(pandas.to_numeric, downcast='integer')
+    return coords_df
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent local store of annotations, used to sync collections
+incrementally.
+
+Each collection is stored as a dataframe of extracted annotation fields,
+keyed by annotation ID. The created and modified watermarks recorded at the
+last sync are kept in a small JSON file alongside, so they can be checked
+without loading the annotations.
+
+By default the annotations are pickled. If the columnar backend is enabled
+(see `columnar_cache.py`) they are stored as Parquet, partitioned by
+manifest, so that a sync only rewrites the manifests that changed and
+readers can load just the columns they need.
+"""
+import os
+import re
+import json
+import pandas
+
+import columnar_cache
+from helpers import save_pickle, load_pickle, mkdirs, CACHE, CACHE_BACKEND
+from annotation_columns import COLUMNS, FORMAT_VERSION
+
+
+def get_store_path(url, ext='pkl'):
+    """Return the path to the local store for a collection."""
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', url).strip('-')
+    return os.path.join(CACHE.directory, 'annotations',
+                        '{0}.{1}'.format(slug, ext))
+
+
+def get_dataset_name(url):
+    """Return the name of the columnar dataset for a collection."""
+    return 'annotations/{}'.format(url)
+
+
+def _max_timestamp(df, col):
+    """Return the latest ISO 8601 timestamp in a column."""
+    if col not in df.columns:
+        return None
+    values = df[col].dropna()
+    if values.empty:
+        return None
+    return values.max()
+
+
+def get_watermarks(df):
+    """Return the created and modified watermarks for some annotations.
+
+    The modified watermark is never earlier than the created watermark, as
+    any annotation changed since the last sync must have been modified after
+    the last annotation we know about was created.
+    """
+    created = _max_timestamp(df, 'created')
+    modified = _max_timestamp(df, 'modified')
+    if not modified or (created and created > modified):
+        modified = created
+    return {
+        'created': created,
+        'modified': modified
+    }
+
+
+def _merge_watermarks(old, new):
+    """Return the later of two sets of watermarks."""
+    return dict((key, max([v for v in (old[key], new[key]) if v] or [None]))
+                for key in ('created', 'modified'))
+
+
+def load_watermarks(url):
+    """Return the watermarks and count for a collection's store.
+
+    Stores holding a different format of fields, or written by a different
+    backend, are ignored.
+    """
+    path = get_store_path(url, 'json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        meta = json.load(f)
+    if (meta.get('version') != FORMAT_VERSION or meta['columns'] != COLUMNS or
+            meta.get('backend') != CACHE_BACKEND):
+        return None
+    return meta
+
+
+def _save_meta(url, meta):
+    """Save the metadata for a collection's store."""
+    path = get_store_path(url, 'json')
+    mkdirs(os.path.dirname(path))
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+
+
+def _save_watermarks(url, watermarks, count):
+    """Save the watermarks and count for a collection's store."""
+    meta = dict(watermarks, count=count, columns=COLUMNS,
+                version=FORMAT_VERSION, backend=CACHE_BACKEND)
+    _save_meta(url, meta)
+
+
+def save_fingerprint(url, fingerprint):
+    """Save the collection fingerprint recorded when the store was synced."""
+    meta = load_watermarks(url)
+    meta['fingerprint'] = fingerprint
+    _save_meta(url, meta)
+
+
+def read_store(url, columns=None):
+    """Return the stored annotations for a collection.
+
+    With the columnar backend only the given columns are read.
+    """
+    if columnar_cache.enabled():
+        return columnar_cache.read_dataset(get_dataset_name(url), columns)
+    df = load_pickle(get_store_path(url))
+    return df[columns] if columns and df is not None else df
+
+
+def iter_store_manifests(url):
+    """Yield the stored annotations for a collection, a manifest at a time.
+
+    With the columnar backend each manifest is read from its own partition,
+    so the whole collection is never loaded at once.
+    """
+    if columnar_cache.enabled():
+        name = get_dataset_name(url)
+        metadata = columnar_cache.load_metadata(name) or {'partitions': {}}
+        values = sorted(set(part['value']
+                            for part in metadata['partitions'].values()),
+                        key=lambda value: value or '')
+        for value in values:
+            yield value, columnar_cache.read_dataset(name, partitions=[value])
+        return
+
+    df = read_store(url)
+    if df is None:
+        return
+    keys = df['partOf'].where(df['partOf'].notnull(), '')
+    for value, part_df in df.groupby(keys, sort=True):
+        yield value or None, part_df
+
+
+def write_store(url, df):
+    """Replace the stored annotations for a collection."""
+    df = df.drop_duplicates(subset=['id'], keep='last')
+    df = df.reset_index(drop=True)
+    if columnar_cache.enabled():
+        columnar_cache.write_dataset(get_dataset_name(url), df, 'partOf')
+    else:
+        save_pickle(df, get_store_path(url))
+    _save_watermarks(url, get_watermarks(df), len(df))
+
+
+def _merge(df, changed_df):
+    """Return annotations with the changed annotations merged in by ID."""
+    df = df[~df['id'].isin(changed_df['id'])]
+    df = pandas.concat([df, changed_df], ignore_index=True, sort=False)
+    return df.drop_duplicates(subset=['id'], keep='last')
+
+
+def merge_store(url, changed_df):
+    """Merge new or changed annotations into a store and return the count.
+
+    With the columnar backend only the manifests containing changed
+    annotations are read and rewritten.
+    """
+    meta = load_watermarks(url)
+    if changed_df.empty:
+        return meta['count']
+
+    watermarks = _merge_watermarks(meta, get_watermarks(changed_df))
+    if columnar_cache.enabled():
+        name = get_dataset_name(url)
+        part_of = set(changed_df['partOf'])
+        df = columnar_cache.read_dataset(name, partitions=part_of)
+        merged_df = _merge(df, changed_df).reset_index(drop=True)
+        columnar_cache.write_partitions(name, merged_df, 'partOf')
+        count = meta['count'] - len(df) + len(merged_df)
+    else:
+        merged_df = _merge(read_store(url), changed_df)
+        save_pickle(merged_df.reset_index(drop=True), get_store_path(url))
+        count = len(merged_df)
+    _save_watermarks(url, watermarks, count)
+    return count
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the scripts in this repository.
+
+```
+python scripts/benchmark.py annotations --n-annotations 20000 --latency 0.05
+```
+
+The download benchmark starts a stand-in server (see `stand_in_server.py`)
+in a background thread so that no requests are sent to the live services.
+
+```
+python scripts/benchmark.py stages --size 10000 --size 1000000
+```
+
+The stages benchmark times building each output from synthetic data (see
+`synthetic.py`) of each size, and records the peak memory allocated. The
+results are saved to a JSON file in `benchmarks/`, named after the current
+commit, and two results files can be compared with:
+
+```
+python scripts/benchmark.py compare benchmarks/<old>.json benchmarks/<new>.json
+```
+
+The memory report shows the bytes used by each column of the synthetic
+annotations, stored as plain objects and in the compact form used by the
+scripts (see `annotation_columns.py`).
+
+```
+python scripts/benchmark.py memory --size 1000000
+```
+"""
+import os
+import json
+import time
+import click
+import shutil
+import platform
+import datetime
+import tempfile
+import subprocess
+import tracemalloc
+import pandas
+
+import synthetic
+from annotation_columns import CATEGORY_COLUMNS
+from stand_in_server import start_server
+from get_annotations import download_annotations
+from get_its_sheets import build_sheets_df
+from get_its_title_index import build_title_index_df
+from get_its_performances import build_performances_df
+from get_its_tweets import build_tweets_df
+from cac import build_new_df
+from ingested import build_ingested_df
+from lookups import build_task_lookup_df
+from helpers import get_volumes_df, mkdirs, CACHE
+
+
+STAGES = ['ingested', 'new', 'sheets', 'title-index', 'performances',
+          'tweets']
+
+
+def time_call(func, *args, **kwargs):
+    """Return the result of a function call and the seconds it took."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--n-annotations', default=10000, show_default=True)
+@click.option('--per-page', default=100, show_default=True)
+@click.option('--latency', default=0.05, show_default=True,
+              help='Seconds the stand-in server waits before responding.')
+@click.option('--workers', '-w', multiple=True, type=int,
+              default=[1, 2, 4, 8, 16], show_default=True)
+def annotations(n_annotations, per_page, latency, workers):
+    """Time downloading an annotation collection for each worker limit."""
+    server = start_server(n_annotations=n_annotations, per_page=per_page,
+                          latency=latency)
+    url = '{}/annotations/playbills-results/'.format(server.base_url)
+    results = []
+    try:
+        for n_workers in workers:
+            data, seconds = time_call(download_annotations, url, n_workers)
+            assert len(data) == n_annotations
+            results.append((n_workers, seconds))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    baseline = results[0][1]
+    print('{0:>8} {1:>10} {2:>8}'.format('workers', 'seconds', 'speedup'))
+    for n_workers, seconds in results:
+        print('{0:>8} {1:>10.3f} {2:>7.1f}x'.format(n_workers, seconds,
+                                                   baseline / seconds))
+
+
+def get_commit():
+    """Return the short hash of the current commit, if known."""
+    here = os.path.abspath(os.path.dirname(__file__))
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=here, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return out.decode('utf-8').strip()
+
+
+def get_results_path(commit):
+    """Return the default path for a results file."""
+    here = os.path.abspath(os.path.dirname(__file__))
+    return os.path.join(os.path.dirname(here), 'benchmarks',
+                        'stages-{}.json'.format(commit))
+
+
+def clear_marc_cache(paths):
+    """Remove the cached fields of some MARC files, so they are parsed."""
+    for path in paths:
+        CACHE.delete(('marc', os.path.abspath(path)))
+
+
+def measure(func, setup=None, memory=True):
+    """Return the result of a function, the seconds taken and peak memory.
+
+    If `memory` is True the function is called again while tracing memory
+    allocations, so that tracing does not slow down the timed call.
+    """
+    if setup:
+        setup()
+    result, seconds = time_call(func)
+    peak = None
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def benchmark_stages(size, stages, seed=0, memory=True):
+    """Time building the chosen stages from synthetic data of a size.
+
+    Yields a result for each stage. Stages that the chosen stages depend on
+    are built, but not timed.
+    """
+    volumes_df = get_volumes_df()
+    its_df = synthetic.make_its_annotations_df(size, volumes_df.index, seed)
+    its_tasks_df = build_task_lookup_df(*synthetic.make_pybossa_dfs(its_df))
+    cac_df = synthetic.make_cac_annotations_df(size, seed)
+    cac_tasks_df = build_task_lookup_df(*synthetic.make_pybossa_dfs(cac_df))
+    references = cac_df[cac_df['tag'] == 'reference']['transcription']
+    lex_dir = tempfile.mkdtemp()
+    lex_paths = synthetic.write_lex_files(lex_dir, references.iloc[::2],
+                                          seed=seed)
+
+    values = {}
+    funcs = {
+        'ingested': (lambda: build_ingested_df(lex_paths),
+                     lambda: clear_marc_cache(lex_paths)),
+        'new': (lambda: build_new_df(cac_df, cac_tasks_df, frozenset(
+                    values['ingested']['normalised_shelfmark'])), None),
+        'sheets': (lambda: build_sheets_df(its_df, volumes_df), None),
+        'title-index': (lambda: build_title_index_df(its_df), None),
+        'performances': (lambda: build_performances_df(its_df, volumes_df,
+                                                       its_tasks_df), None),
+        'tweets': (lambda: build_tweets_df(values['performances']), None)
+    }
+    dependencies = {'new': 'ingested', 'tweets': 'performances'}
+    needed = set(stages) | set(dependencies[name] for name in stages
+                               if name in dependencies)
+    try:
+        for name in STAGES:
+            if name not in needed:
+                continue
+            func, setup = funcs[name]
+            if name not in stages:
+                values[name] = func()
+                continue
+            values[name], seconds, peak = measure(func, setup, memory)
+            yield {
+                'stage': name,
+                'size': size,
+                'rows': len(values[name]),
+                'seconds': seconds,
+                'peak_bytes': peak
+            }
+    finally:
+        clear_marc_cache(lex_paths)
+        shutil.rmtree(lex_dir, ignore_errors=True)
+
+
+def format_bytes(n):
+    """Return a number of bytes in megabytes, for display."""
+    return '-' if n is None else '{:.1f}'.format(n / 1e6)
+
+
+@cli.command()
+@click.option('--size', '-s', 'sizes', multiple=True, type=int,
+              default=[10000, 100000, 1000000], show_default=True,
+              help='Number of synthetic annotations, e.g. up to 10000000.')
+@click.option('--stage', 'stages', multiple=True, type=click.Choice(STAGES),
+              help='Only benchmark the chosen stages.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--no-memory', is_flag=True, default=False,
+              help='Do not record peak memory, which doubles the run time.')
+@click.option('--output', '-o', default=None, type=click.Path(),
+              help='Results file, by default benchmarks/stages-<commit>.json')
+def stages(sizes, stages, seed, no_memory, output):
+    """Time building each output from synthetic data of each size."""
+    stages = list(stages) or STAGES
+    commit = get_commit()
+    results = []
+    print('{0:>14} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        'stage', 'size', 'rows', 'seconds', 'peak MB'))
+    for size in sizes:
+        for result in benchmark_stages(size, stages, seed, not no_memory):
+            results.append(result)
+            print('{0:>14} {1:>10} {2:>10} {3:>10.3f} {4:>10}'.format(
+                result['stage'], size, result['rows'], result['seconds'],
+                format_bytes(result['peak_bytes'])))
+
+    output = output or get_results_path(commit)
+    mkdirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'pandas': pandas.__version__,
+            'seed': seed,
+            'results': results
+        }, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+
+@cli.command()
+@click.argument('old', type=click.File())
+@click.argument('new', type=click.File())
+def compare(old, new):
+    """Compare two stages results files."""
+    old = json.load(old)
+    new = json.load(new)
+    old_results = dict(((r['stage'], r['size']), r) for r in old['results'])
+    print('{0} -> {1}'.format(old['commit'], new['commit']))
+    print('{0:>14} {1:>10} {2:>10} {3:>10} {4:>8} {5:>10} {6:>10}'.format(
+        'stage', 'size', 'old s', 'new s', 'speedup', 'old MB', 'new MB'))
+    for result in new['results']:
+        key = (result['stage'], result['size'])
+        if key not in old_results:
+            continue
+        before = old_results[key]
+        print('{0:>14} {1:>10} {2:>10.3f} {3:>10.3f} {4:>7.1f}x {5:>10} '
+              '{6:>10}'.format(result['stage'], result['size'],
+                               before['seconds'], result['seconds'],
+                               before['seconds'] / result['seconds'],
+                               format_bytes(before['peak_bytes']),
+                               format_bytes(result['peak_bytes'])))
+
+
+def expand_df(df):
+    """Return compact annotations with categoricals stored as objects."""
+    dtypes = dict((col, object) for col in CATEGORY_COLUMNS
+                  if col in df.columns)
+    dtypes['task_id'] = 'int64'
+    return df.astype(dtypes)
+
+
+@cli.command()
+@click.option('--size', '-s', 'sizes', multiple=True, type=int,
+              default=[100000], show_default=True,
+              help='Number of synthetic annotations.')
+@click.option('--seed', default=0, show_default=True)
+def memory(sizes, seed):
+    """Show the memory saved by the compact annotations of each size."""
+    volumes_df = get_volumes_df()
+    for size in sizes:
+        for name, df in [
+            ('its', synthetic.make_its_annotations_df(size, volumes_df.index,
+                                                      seed)),
+            ('cac', synthetic.make_cac_annotations_df(size, seed))
+        ]:
+            compact = df.memory_usage(index=True, deep=True)
+            plain = expand_df(df).memory_usage(index=True, deep=True)
+            print('{0} annotations ({1} rows)'.format(name, len(df)))
+            print('{0:>14} {1:>10} {2:>10} {3:>8}'.format(
+                'column', 'plain MB', 'compact MB', 'saved'))
+            for col in plain.index.tolist() + ['total']:
+                before = plain.sum() if col == 'total' else plain[col]
+                after = compact.sum() if col == 'total' else compact[col]
+                print('{0:>14} {1:>10} {2:>10} {3:>7.0f}%'.format(
+                    col, format_bytes(before), format_bytes(after),
+                    100 * (1 - after / float(before)) if before else 0))
+
+
+if __name__ == '__main__':
+    cli()
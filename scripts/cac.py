@@ -1,133 +1,81 @@
 #-*- coding: utf-8 -*-
 """
 Generate Convert-a-Card data.
+
+Outputs are only produced again when their inputs have changed since the
+last run. Use `--only` to choose outputs, `--jobs` to set how many stages
+run at once and `--force` to produce all outputs regardless. Use `--delta`
+to also export the rows added, changed and removed since the last export,
+and `--profile` to save a report of the time and resources used by each
+stage to the `reports` directory.
 """
-import os
-import re
 import csv
-import pandas
 import click
-from pymarc import MARCReader
-
-from get_pybossa_objects import get_pybossa_df
-from get_annotations import get_annotations_df
-from helpers import write_to_csv, get_tag, get_task_id, get_transcription
-from helpers import normalise_shelfmark
 
-
-def get_marc_file_paths():
-    """Return a list of paths to MARC metadata files."""
-    here = os.path.abspath(os.path.dirname(__file__))
-    path = os.path.join(os.path.dirname(here), 'metadata', 'convert-a-card')
-    return [os.path.join(path, fn) for fn in os.listdir(path)]
+import instrument
+from normalise import get_normalised_df
+from lookups import add_task_columns, get_task_lookup_df
+from ingested import get_ingested_df, filter_ingested
+from pipeline import Stage, run_pipeline
+from helpers import ANNOTATIONS_URL
 
 
 def get_cac_annotations():
-    """Return the Convert-a-Card annotations."""
-    url_base = 'https://annotations.libcrowds.com'
+    """Return the normalised Convert-a-Card annotations."""
+    url_base = ANNOTATIONS_URL.rstrip('/')
     container_id = 'convert-a-card-results'
     url = '{0}/annotations/{1}/'.format(url_base, container_id)
-    df = get_annotations_df(url)
-    return df
-
-
-def add_columns(df):
-    """Add required columns to the dataframe."""
-    df['tag'] = df['body'].apply(get_tag)
-    df['task_id'] = df['generator'].apply(get_task_id)
-    df['transcription'] = df['body'].apply(get_transcription)
+    df = get_normalised_df(url)
     return df
 
 
 def create_reference_lookup_df(df):
     """Return a dataframe indexed by task_id for looking up the reference."""
     df = df[df['tag'] == 'reference']
-    df.drop_duplicates(subset=['task_id'], inplace=True)
-    df.set_index('task_id', verify_integrity=True, inplace=True)
-    return df
-
+    df = df.drop_duplicates(subset=['task_id'])
+    df = df.set_index('task_id', verify_integrity=True)
+    return df[['transcription']].rename(columns={'transcription': 'shelfmark'})
 
-def lookup_reference(task_id, reference_df):
-    """Lookup the reference for a task ID."""
-    try:
-        series = reference_df.loc[task_id]
-    except KeyError:
-        return ''
-    return series.transcription
 
-
-def fix_unclosed_brackets(value):
+def fix_unclosed_brackets(series):
     """Fix unclosed brackets at the end of shelfmarks."""
-    s = value
-    if re.search(r'\([^\)]*$', s):
-        s = '{})'.format(s)
-    if re.search(r'\[[^\]]*$', s):
-        s = '{}]'.format(s)
+    s = series
+    s = s.where(~s.str.contains(r'\([^\)]*$'), s + ')')
+    s = s.where(~s.str.contains(r'\[[^\]]*$'), s + ']')
     return s
 
 
-def capitalise_chi(value):
+def capitalise_chi(series):
     """CHI at the start of shelfmarks should always be capitalised."""
-    return re.sub(r'(?i)^chi\.', 'CHI.', value)
+    return series.str.replace(r'(?i)^chi\.', 'CHI.', regex=True)
 
 
 def add_shelfmark_column(df):
     """Add shelfmark column."""
     reference_df = create_reference_lookup_df(df)
-    df['shelfmark'] = df['task_id'].apply(lookup_reference,
-                                          args=(reference_df,))
-    df['shelfmark'] = df['shelfmark'].apply(fix_unclosed_brackets)
-    df['shelfmark'] = df['shelfmark'].apply(capitalise_chi)
+    df = df.merge(reference_df, left_on='task_id', right_index=True,
+                  how='left')
+    df['shelfmark'] = df['shelfmark'].fillna('')
+    df['shelfmark'] = fix_unclosed_brackets(df['shelfmark'])
+    df['shelfmark'] = capitalise_chi(df['shelfmark'])
     return df
 
 
-def filter_new_items(df):
+def filter_new_items(df, index=None):
     """Return rows where a record has not already been created."""
-    ingested_df = get_ingested_df()
-    norm_sm = ingested_df['normalised_shelfmark'].tolist()
-    df['ingested'] = df['shelfmark'].apply(lambda s: normalise_shelfmark(s) in norm_sm)
-    df = df[~df.ingested]
-    return df
-
-
-def get_project_name(task_id, tasks_df, projects_df):
-    """Return the project name from the task ID."""
-    task = tasks_df.loc[int(task_id)]
-    project = projects_df.loc[int(task.project_id)]
-    return project['name']
-
+    return filter_ingested(df, index)
 
-def get_link(task_id, tasks_df):
-    """Return the task link from the task ID."""
-    task = tasks_df.loc[int(task_id)]
-    return task['info']['link']
 
+def build_new_df(df, task_lookup_df=None, index=None):
+    """Return the OCLC to shelfmark index from the normalised annotations.
 
-def add_project_column(df):
-    """Add column for the project title."""
-    tasks_df = get_pybossa_df('task')
-    projects_df = get_pybossa_df('project')
-    df['project'] = df['task_id'].apply(get_project_name,
-                                        args=(tasks_df, projects_df,))
-    return df
-
-
-def add_link_column(df):
-    """Add column for the image link."""
-    tasks_df = get_pybossa_df('task')
-    df['link'] = df['task_id'].apply(get_link, args=(tasks_df,))
-    return df
-
-
-def get_new_df():
-    """Return the Convert-a-Card OCLC to shelfmark index as a dataframe."""
-    df = get_cac_annotations()
-    df = add_columns(df)
-    df = df[df['motivation'] == 'describing']
+    The shared task lookup table and shelfmark index are used unless others
+    are given.
+    """
+    df = df[df['motivation'] == 'describing'].copy()
     df = add_shelfmark_column(df)
-    df = filter_new_items(df)
-    df = add_project_column(df)
-    df = add_link_column(df)
+    df = filter_new_items(df, index)
+    df = add_task_columns(df, ['project', 'link'], lookup_df=task_lookup_df)
     df = df[df['tag'] == 'control_number']
     df = df.rename(columns={'transcription': 'control_number'})
     df.drop_duplicates(subset=['shelfmark'], inplace=True)
@@ -141,30 +89,44 @@ def get_new_df():
     ]]
 
 
-def get_ingested_df():
-    """Return a summary of records already created from Convert-a-Card."""
-    paths = get_marc_file_paths()
-    out = []
-    for path in paths:
-        with open(path, 'rb') as f:
-            reader = MARCReader(f)
-            for record in reader:
-                out.append({
-                    'language': record['008'].data[35:38],
-                    'shelfmark': record['852']['j']
-                })
-    df = pandas.DataFrame(out)
-    df['normalised_shelfmark'] = df['shelfmark'].apply(normalise_shelfmark)
-    return df
+def get_new_df():
+    """Return the Convert-a-Card OCLC to shelfmark index as a dataframe."""
+    return build_new_df(get_cac_annotations())
 
 
-@click.command()
-def main():
-    new_df = get_new_df()
-    write_to_csv(new_df, 'data', 'cac', 'new.csv')
+STAGES = [
+    Stage('annotations', get_cac_annotations),
+    Stage('tasks', get_task_lookup_df),
+    Stage('marc', get_ingested_df),
+    Stage('new',
+          lambda df, tasks_df, ingested_df: build_new_df(
+              df, tasks_df, frozenset(ingested_df['normalised_shelfmark'])),
+          inputs=['annotations', 'tasks', 'marc'],
+          output=('data', 'cac', 'new.csv'), key='shelfmark'),
+    Stage('ingested', lambda ingested_df: ingested_df,
+          inputs=['marc'],
+          output=('data', 'cac', 'ingested.csv'))
+]
+
 
-    ingested_df = get_ingested_df()
-    write_to_csv(ingested_df, 'data', 'cac', 'ingested.csv')
+@click.command()
+@click.option('--only', multiple=True, type=click.Choice(['new', 'ingested']),
+              help='Only produce the chosen output.')
+@click.option('--jobs', default=2, show_default=True,
+              help='Maximum number of stages to run at once.')
+@click.option('--force', is_flag=True, default=False,
+              help='Produce outputs even if their inputs have not changed.')
+@click.option('--delta', is_flag=True, default=False,
+              help='Also export the rows changed since the last export.')
+@click.option('--profile', is_flag=True, default=False,
+              help='Save a report of the time and resources used by stages.')
+@click.option('--profile-stage', default=None,
+              type=click.Choice([stage.name for stage in STAGES]),
+              help='Also save cProfile stats for the chosen stage.')
+def main(only, jobs, force, delta, profile, profile_stage):
+    run_pipeline(STAGES, only, jobs, force, delta, profile_stage)
+    if profile or profile_stage:
+        instrument.write_report('cac')
 
 
 if __name__ == "__main__":
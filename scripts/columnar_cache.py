@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Optional columnar cache backend, storing dataframes as Parquet datasets.
+
+Set the `LIBCROWDS_CACHE_BACKEND` environment variable to `parquet` to use
+this backend, which requires pyarrow. Each dataset is a directory containing
+a Parquet file per partition (e.g. per manifest) and a JSON metadata file.
+Partitions and columns can be read selectively, using memory-mapped reads,
+without loading the rest of the dataset.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import pandas
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+from helpers import mkdirs, CACHE, CACHE_BACKEND
+
+
+METADATA_FN = 'metadata.json'
+
+
+def enabled():
+    """Check if the columnar backend has been chosen."""
+    if CACHE_BACKEND != 'parquet':
+        return False
+    if pyarrow is None:
+        raise ImportError('The parquet cache backend requires pyarrow')
+    return True
+
+
+def get_dataset_dir(name):
+    """Return the directory containing a dataset."""
+    parts = [re.sub(r'[^A-Za-z0-9]+', '-', p).strip('-')
+             for p in name.split('/')]
+    return os.path.join(CACHE.directory, 'columnar', *parts)
+
+
+def get_partition_fn(value):
+    """Return the file name for a partition."""
+    key = hashlib.md5(json.dumps(value).encode('utf-8')).hexdigest()
+    return '{}.parquet'.format(key)
+
+
+def load_metadata(name):
+    """Return the metadata for a dataset, or None if it does not exist."""
+    path = os.path.join(get_dataset_dir(name), METADATA_FN)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_metadata(name, metadata):
+    """Save the metadata for a dataset."""
+    path = os.path.join(get_dataset_dir(name), METADATA_FN)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(tmp_path, path)
+
+
+def get_nested_columns(df):
+    """Return the columns containing dicts or lists in any of their cells."""
+    nested = []
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        if df[col].map(lambda v: isinstance(v, (dict, list))).any():
+            nested.append(col)
+    return nested
+
+
+def encode_nested(df, nested):
+    """JSON encode nested columns, which Parquet cannot store as is."""
+    if not nested:
+        return df
+    df = df.copy()
+    for col in nested:
+        df[col] = df[col].apply(json.dumps)
+    return df
+
+
+def _decode_nested(df, nested):
+    """Decode JSON encoded nested columns."""
+    for col in nested:
+        if col in df.columns:
+            df[col] = df[col].apply(json.loads)
+    return df
+
+
+def _write_partition(dataset_dir, fn, df):
+    """Write a partition to a Parquet file."""
+    path = os.path.join(dataset_dir, fn)
+    tmp_path = '{}.tmp'.format(path)
+    table = pyarrow.Table.from_pandas(df, preserve_index=True)
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_partitions(name, df, partition_col=None, replace=False, **extra):
+    """Write the partitions of a dataframe, replacing those already stored.
+
+    If `replace` is True all other partitions are dropped from the dataset.
+    Any extra keyword arguments are saved to the dataset's metadata.
+    """
+    dataset_dir = get_dataset_dir(name)
+    mkdirs(dataset_dir)
+    metadata = None if replace else load_metadata(name)
+    metadata = metadata or {'partitions': {}}
+    nested = get_nested_columns(df)
+    if nested:
+        metadata['nested'] = nested
+    metadata['columns'] = df.columns.tolist()
+    metadata['index'] = df.index.name
+    df = encode_nested(df, metadata.get('nested', []))
+
+    if partition_col:
+        keys = df[partition_col].where(df[partition_col].notnull(), '')
+        groups = df.groupby(keys, sort=False)
+    else:
+        groups = [('', df)]
+
+    for value, part_df in groups:
+        if hasattr(value, 'item'):  # numpy scalar
+            value = value.item()
+        value = value if value != '' else None
+        fn = get_partition_fn(value)
+        _write_partition(dataset_dir, fn, part_df)
+        metadata['partitions'][fn] = {'value': value, 'rows': len(part_df)}
+
+    metadata.update(extra)
+    metadata['updated'] = time.time()
+    save_metadata(name, metadata)
+    return metadata
+
+
+def write_dataset(name, df, partition_col=None, **extra):
+    """Write a dataframe as a dataset, replacing any existing dataset."""
+    dataset_dir = get_dataset_dir(name)
+    metadata = write_partitions(name, df, partition_col, replace=True,
+                                **extra)
+    for fn in os.listdir(dataset_dir):
+        if fn.endswith('.parquet') and fn not in metadata['partitions']:
+            os.remove(os.path.join(dataset_dir, fn))
+    return metadata
+
+
+def read_dataset(name, columns=None, partitions=None):
+    """Read a dataset into a dataframe, or return None if it does not exist.
+
+    Only the given columns and the partitions for the given values are read.
+    """
+    metadata = load_metadata(name)
+    if metadata is None:
+        return None
+    dataset_dir = get_dataset_dir(name)
+    fns = [fn for fn, part in metadata['partitions'].items()
+           if partitions is None or part['value'] in partitions]
+    dfs = [pq.read_table(os.path.join(dataset_dir, fn), columns=columns,
+                         memory_map=True, use_pandas_metadata=True).to_pandas()
+           for fn in fns]
+    if not dfs:
+        df = pandas.DataFrame(columns=columns or metadata['columns'])
+        df.index.name = metadata['index']
+        return df
+    df = pandas.concat(dfs, sort=False) if len(dfs) > 1 else dfs[0]
+    return _decode_nested(df, metadata.get('nested', []))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Write the rows of an output that have changed since it was last exported.
+
+A snapshot of the hash of each row, by key, is saved to the cache directory
+(e.g. `cache/snapshots/data/cac/new.snapshot.pkl`), so that it is not sent
+off with the outputs. Each export compares the hashes of the current rows
+against the snapshot and writes three files alongside the output: the rows
+that were added, the rows that were changed and the keys of the rows that
+were removed (e.g. `new.added.csv`, `new.changed.csv` and `new.removed.csv`).
+"""
+import os
+import pandas
+
+from fingerprints import hash_rows
+from output import write_output
+from helpers import save_pickle, load_pickle, CACHE
+
+
+def get_snapshot_path(*path_parts):
+    """Return the path to the snapshot for an output, in the cache."""
+    name = path_parts[-1].split('.')[0]
+    return os.path.join(CACHE.directory, 'snapshots', *path_parts[:-1],
+                        '{}.snapshot.pkl'.format(name))
+
+
+def get_row_hashes(df, key):
+    """Return the hash of each row in a dataframe, indexed by key."""
+    keys = df[key]
+    if keys.duplicated().any():
+        raise ValueError('Delta export keys must be unique: {}'.format(key))
+    hashes = hash_rows(df)
+    hashes.index = keys.values
+    return hashes
+
+
+def get_delta(hashes, columns, snapshot):
+    """Return the keys added, changed and removed since the snapshot.
+
+    If the columns have changed all rows kept since the snapshot are
+    considered to have changed.
+    """
+    if snapshot is None:
+        previous = pandas.Series([], dtype='uint64')
+    else:
+        previous = snapshot['hashes']
+    is_added = ~hashes.index.isin(previous.index)
+    is_removed = ~previous.index.isin(hashes.index)
+    kept = hashes[~is_added]
+    is_changed = kept.values != previous.reindex(kept.index).values
+    if snapshot is not None and snapshot['columns'] != columns:
+        is_changed[:] = True
+    return (hashes.index[is_added], kept.index[is_changed],
+            previous.index[is_removed])
+
+
+def get_delta_path_parts(path_parts, change):
+    """Return the path parts for a file of added, changed or removed rows."""
+    name, ext = path_parts[-1].split('.', 1)
+    fn = '{0}.{1}.{2}'.format(name, change, ext)
+    return tuple(path_parts[:-1]) + (fn,)
+
+
+def write_delta(df, key, *path_parts):
+    """Write the rows added, changed and removed since the last export.
+
+    The snapshot is only updated once all three files have been written.
+    """
+    snapshot_path = get_snapshot_path(*path_parts)
+    columns = df.columns.tolist()
+    hashes = get_row_hashes(df, key)
+    added, changed, removed = get_delta(hashes, columns,
+                                        load_pickle(snapshot_path))
+
+    write_output(df[df[key].isin(added)],
+                 *get_delta_path_parts(path_parts, 'added'))
+    write_output(df[df[key].isin(changed)],
+                 *get_delta_path_parts(path_parts, 'changed'))
+    write_output(pandas.DataFrame({key: removed}),
+                 *get_delta_path_parts(path_parts, 'removed'))
+    save_pickle({'columns': columns, 'hashes': hashes}, snapshot_path)
+    print('{0} added, {1} changed and {2} removed'.format(
+        len(added), len(changed), len(removed)))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Memoize functions by fingerprints of their inputs.
+
+Rather than expiring after a fixed time, a memoized result is reused for as
+long as a cheap probe of its inputs (e.g. the number of annotations in a
+collection, or a hash of a metadata file) returns the same fingerprint.
+"""
+import hashlib
+import functools
+import pandas
+
+import instrument
+from helpers import CACHE
+from columnar_cache import get_nested_columns, encode_nested
+
+
+def hash_file(path, algorithm='sha1'):
+    """Return the hash of a file's contents, SHA-1 by default."""
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_rows(df, index=False):
+    """Return a 64-bit hash of each row of a dataframe.
+
+    Columns containing lists or dicts are JSON encoded before hashing.
+    """
+    df = encode_nested(df, get_nested_columns(df))
+    return pandas.util.hash_pandas_object(df, index=index)
+
+
+def is_reliable(fingerprint):
+    """Check that no part of a fingerprint is unknown."""
+    if isinstance(fingerprint, (tuple, list)):
+        return all(is_reliable(part) for part in fingerprint)
+    return fingerprint is not None
+
+
+def memoize(probe, tag=None):
+    """Memoize a function in the cache, keyed by the fingerprint of its inputs.
+
+    The probe is called with the same arguments as the function and should
+    return a fingerprint of its inputs. If any part of the fingerprint is
+    None the inputs cannot be checked, so the function is always called.
+    """
+    def decorator(func):
+        base = '{0}.{1}'.format(func.__module__, func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (base, args, tuple(sorted(kwargs.items())))
+            fingerprint = probe(*args, **kwargs)
+            cached = CACHE.get(key, retry=True)
+            if (cached is not None and is_reliable(fingerprint) and
+                    cached['fingerprint'] == fingerprint):
+                instrument.count(cache_hits=1)
+                return cached['result']
+
+            instrument.count(cache_misses=1)
+            result = func(*args, **kwargs)
+            CACHE.set(key, {
+                'fingerprint': fingerprint,
+                'result': result
+            }, tag=tag, retry=True)
+            return result
+        return wrapper
+    return decorator
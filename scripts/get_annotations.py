@@ -1,38 +1,89 @@
 # -*- coding: utf-8 -*-
 """
 Download all annotations for a collection and load them into a pandas
-dataframe. This functionality is used as part of the input for various other
-scripts in this repository. If run as a standalone script, using the command
-below, the annotations will be output to a CSV file.
+dataframe, with a column for each of the fields used by other scripts (see
+`annotation_columns.py`). This functionality is used as part of the input
+for various other scripts in this repository. If run as a standalone script,
+using the command below, the extracted fields will be output to a CSV file.
 
 ```
 python scripts/get_annotations.py http://annotations.libcrowds.com/annotations/my-collection
 ```
 
-The CSV file will be saved to `data/annotations.csv`.
+The CSV file will be saved to `data/annotation-fields.csv`. This replaces
+`data/annotations.csv`, which held the full annotation records, as only the
+extracted fields are kept.
+
+Several collections can be given at once, in which case they are downloaded
+concurrently, sharing one progress bar, and each is saved to
+`data/annotation-fields/<host>-<collection>.csv`. Use the `--jobs` option to
+change the maximum number of collections downloaded at once.
+
+```
+python scripts/get_annotations.py <collection-url> <collection-url> ...
+```
+
+Pages are downloaded concurrently, use the `--workers` option to change the
+maximum number of simultaneous requests.
+
+Annotations are kept in a local store (see `annotation_store.py`). Once a
+collection has been downloaded, subsequent runs only fetch the annotations
+created or modified since the last sync. Use the `--full` flag to download
+the whole collection again.
 """
+import re
 import sys
-import tqdm
-import time
+import json
+import math
 import click
-import pandas
 import requests
-import datetime
+import functools
+import collections
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrument
+import http_client
+from output import write_output
+from progress import Progress, shared_progress
+from annotation_columns import ColumnBuffers, compact_df
+from annotation_store import load_watermarks, read_store, write_store
+from annotation_store import merge_store, save_fingerprint
 
-from helpers import write_to_csv, CACHE
+
+DEFAULT_WORKERS = 8
+
+DEFAULT_JOBS = 4
 
 
 def get_n_annotations(url):
     """Get the number of playbills results annotations on the server."""
-    r = requests.get(url)
+    r = http_client.get(url)
     r.raise_for_status()
     n_annotations = r.json()['total']
     return n_annotations
 
 
+@functools.lru_cache(maxsize=None)
+def get_collection_fingerprint(url):
+    """Return the total and any ETag or last modified time of a collection.
+
+    The probe is made once per run. If the server provides neither header
+    the fingerprint is None, as changes to existing annotations could not be
+    detected.
+    """
+    r = http_client.get(url)
+    r.raise_for_status()
+    etag = r.headers.get('etag')
+    last_modified = r.headers.get('last-modified')
+    if not etag and not last_modified:
+        return None
+    return (r.json()['total'], etag, last_modified)
+
+
 def get_annotations(url, page=0):
     """Get a page of annotations."""
-    r = requests.get(url, params={
+    r = http_client.get(url, params={
         'page': page
     })
     if r.status_code == 404:
@@ -47,51 +98,195 @@ def _not_exhausted(last_fetched):
     return len(last_fetched) != 0
 
 
-def respect_rate_limits(response, progress):
-    """If we have exceeded the rate limit sleep until it is refreshed."""
-    reset = response.headers.get('x-ratelimit-reset')
-    remaining = response.headers.get('x-ratelimit-remaining')
-    if not reset or not remaining:
-        # Rate limiting not implemented at the time of writing
-        return
+def get_page_range(n_annotations, per_page):
+    """Return the remaining pages expected to contain the annotations."""
+    if not per_page:
+        return range(0)
+    n_pages = int(math.ceil(n_annotations / float(per_page)))
+    return range(1, n_pages)
+
+
+def iter_pages(url, pages, workers):
+    """Fetch pages concurrently and yield the responses in page order.
 
-    reset_dt = datetime.datetime.fromtimestamp(float(reset))
-    if remaining == 0:
-        progress.write('Sleeping until rate limit refreshed, please wait...')
-        while reset_dt > datetime.datetime.now():
-            time.sleep(1)
+    No more than twice the number of workers are requested ahead of the page
+    currently being consumed, so memory use is bounded by the window.
+    """
+    pages = iter(pages)
+    window = collections.deque()
+    fetch = instrument.bind(get_annotations)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in pages:
+            window.append(executor.submit(fetch, url, page))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
 
 
-@CACHE.memoize(typed=True, expire=3600, tag='annotations')
-def get_annotations_df(url):
-    """Load all annotations into a dataframe and return."""
+def download_annotations(url, workers=DEFAULT_WORKERS):
+    """Download all annotations in a collection and return their fields.
+
+    Each page is parsed into column buffers as soon as it arrives.
+    """
     n_anno = get_n_annotations(url)
-    progress = tqdm.tqdm(desc='Downloading', total=n_anno, unit='annotation')
-    page = 0
-    r = get_annotations(url, page)
+    progress = Progress('Downloading', 'annotation', n_anno)
+    buffers = ColumnBuffers()
+    r = get_annotations(url, 0)
     last_fetched = r.json()['items']
-    data = last_fetched
+    buffers.extend(last_fetched)
     progress.update(len(last_fetched))
-    respect_rate_limits(r, progress)
+
+    pages = get_page_range(n_anno, len(last_fetched))
+    for r in iter_pages(url, pages, workers):
+        if not r:  # 404
+            last_fetched = []
+            break
+        last_fetched = r.json()['items']
+        buffers.extend(last_fetched)
+        progress.update(len(last_fetched))
+
+    # Pick up any annotations created since the total was requested
+    page = len(pages)
     while _not_exhausted(last_fetched):
         page += 1
         r = get_annotations(url, page)
         if not r:  # 404
             break
         last_fetched = r.json()['items']
-        data += last_fetched
+        buffers.extend(last_fetched)
         progress.update(len(last_fetched))
-        respect_rate_limits(r, progress)
     progress.close()
-    df = pandas.DataFrame(data)
-    return df
+    return buffers.to_df()
+
+
+def get_search_url(url):
+    """Return the search endpoint for the server hosting a collection."""
+    return '{}/search/'.format(url.split('/annotations/')[0])
+
+
+def search_annotations(url, query, page=0):
+    """Get a page of annotations from a collection matching a range query."""
+    r = http_client.get(get_search_url(url), params={
+        'collection': url,
+        'range': json.dumps(query),
+        'page': page
+    })
+    if r.status_code == 404 and page > 0:
+        return None
+    else:
+        r.raise_for_status()
+    return r
+
+
+def get_changed_annotations(url, watermarks):
+    """Get fields of annotations created or modified since the watermarks."""
+    queries = [
+        {'created': {'gte': watermarks['created']}},
+        {'modified': {'gte': watermarks['modified']}}
+    ]
+    buffers = ColumnBuffers()
+    for query in queries:
+        page = 0
+        r = search_annotations(url, query, page)
+        while r:
+            last_fetched = r.json()['items']
+            if not _not_exhausted(last_fetched):
+                break
+            buffers.extend(last_fetched)
+            page += 1
+            r = search_annotations(url, query, page)
+    return buffers.to_df()
+
+
+def sync_annotations(url, workers=DEFAULT_WORKERS, full=False):
+    """Sync the local store for a collection.
+
+    Nothing is fetched if the collection's fingerprint has not changed since
+    the last sync. If the number of stored annotations does not match the
+    collection total after syncing (e.g. because annotations were deleted)
+    the whole collection is downloaded again.
+    """
+    watermarks = None if full else load_watermarks(url)
+    fingerprint = get_collection_fingerprint(url)
+    if (watermarks and fingerprint and
+            watermarks.get('fingerprint') == list(fingerprint)):
+        instrument.count(cache_hits=1)
+        return
+
+    instrument.count(cache_misses=1)
+    if watermarks and watermarks['created']:
+        try:
+            changed_df = get_changed_annotations(url, watermarks)
+        except requests.HTTPError:
+            watermarks = None
+        else:
+            count = merge_store(url, changed_df)
+            if count != get_n_annotations(url):
+                watermarks = None
+
+    if not watermarks or not watermarks['created']:
+        write_store(url, download_annotations(url, workers))
+    save_fingerprint(url, fingerprint)
+
+
+def get_annotations_df(url, workers=DEFAULT_WORKERS, full=False,
+                       columns=None):
+    """Load the fields of all annotations into a dataframe and return.
+
+    If the columnar cache backend is enabled only the given columns are
+    loaded from disk. Repeated strings are stored as categoricals.
+    """
+    sync_annotations(url, workers, full)
+    return compact_df(read_store(url, columns))
+
+
+def get_output_parts(url, batch=False):
+    """Return the output path parts for a collection.
+
+    In batch mode each collection is saved to its own file, named after the
+    host and the last part of the path.
+    """
+    if not batch:
+        return ('data', 'annotation-fields.csv')
+    host = re.sub(r'[^A-Za-z0-9]+', '-', urlparse(url).netloc).strip('-')
+    name = url.rstrip('/').split('/')[-1]
+    return ('data', 'annotation-fields', '{0}-{1}.csv'.format(host, name))
+
+
+def save_collections(urls, workers=DEFAULT_WORKERS, full=False,
+                     jobs=DEFAULT_JOBS):
+    """Sync several collections at once and save each to an output file.
+
+    The collections share the pooled connections and rate limits of the
+    HTTP client, and one progress bar. Collections that would be saved to
+    the same file are refused before anything is downloaded.
+    """
+    batch = len(urls) > 1
+    parts = [get_output_parts(url, batch) for url in urls]
+    duplicates = sorted(set(p[-1] for p in parts if parts.count(p) > 1))
+    if duplicates:
+        raise ValueError('Collections would be saved to the same file: '
+                         '{}'.format(', '.join(duplicates)))
+    with shared_progress('Downloading', 'annotation'):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = dict((executor.submit(get_annotations_df, url, workers,
+                                            full), url) for url in urls)
+            for future in as_completed(futures):
+                url = futures[future]
+                write_output(future.result(), *get_output_parts(url, batch))
 
 
 @click.command()
-@click.argument('url')
-def main(url):
-    df = get_annotations_df(url)
-    write_to_csv(df, 'data', 'annotations.csv')
+@click.argument('urls', nargs=-1, required=True)
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True,
+              help='Maximum number of pages to download at once.')
+@click.option('--jobs', default=DEFAULT_JOBS, show_default=True,
+              help='Maximum number of collections to download at once.')
+@click.option('--full', is_flag=True, default=False,
+              help='Download the whole collection instead of syncing.')
+def main(urls, workers, jobs, full):
+    save_collections(urls, workers, full, jobs)
 
 
 if __name__ == '__main__':
@@ -1,23 +1,30 @@
 # -*- coding: utf-8 -*-
 """
 Produce a CSV file containing aggregated data for each performance.
+
+Each title is given the date nearest to it on the same sheet, and each genre
+is linked to the title nearest to it, comparing the vertical centres of their
+fragment selectors. So every title on a sheet with a date has one, and there
+is a row for each title and each genre linked to it. Where a selector
+cannot be parsed the fragment of the related task is used instead, and
+failing that the top of the sheet.
 """
 import click
 import pandas as pd
 
-from get_annotations import get_annotations_df
-from get_pybossa_objects import get_pybossa_df
-from helpers import write_to_csv, get_tag, get_transcription, get_source
-from helpers import get_task_id, get_volumes_df, CACHE
+import fingerprints
+from lookups import add_task_columns
+from normalise import get_normalised_df, PLAYBILLS_URL
+from get_annotations import get_collection_fingerprint
+from get_pybossa_objects import get_max_id
+from fingerprints import hash_file
+from output import write_output
+from annotation_columns import get_selector_coords
+from helpers import get_volumes_df, get_volumes_path
 
 
-def fragment_from_task(task_id, task_df):
-    """Get fragment selector from a PYBOSSA task."""
-    try:
-        task = task_df.loc[int(task_id)]
-    except KeyError:
-        return None
-    return task['info']['target']['selector']['value']
+# Increment when the way performances are built changes
+VERSION = 4
 
 
 def get_df_from_tag(input_df, tag):
@@ -28,84 +35,120 @@ def get_df_from_tag(input_df, tag):
     return df
 
 
-def add_fields(df):
-    """Add fields to the dataframe."""
-    df['tag'] = df['body'].apply(get_tag)
-    df['transcription'] = df['body'].apply(get_transcription)
-    df['source'] = df['target'].apply(get_source)
-    df['task_id'] = df['generator'].apply(get_task_id)
-    return df
-
-
-def add_volume_metadata(df):
+def add_volume_metadata(df, volume_md_df):
     """Add volume metadata to the dataframe."""
-    volume_md_df = get_volumes_df()
     df = df.merge(volume_md_df[['theatre', 'city']], left_on='partOf',
                   right_on='manifest_uri', how='left')
     return df
 
 
-def merge_genres_df(df, genres_df):
-    """Merge genres by matching fragment selectors of related tasks."""
-    tasks_df = get_pybossa_df('task')
-    genres_df['fragment'] = genres_df['task_id'].apply(fragment_from_task,
-                                                       args=(tasks_df,))
-    df['fragment'] = df['task_id_title'].apply(fragment_from_task,
-                                               args=(tasks_df,))
-    df = df.merge(genres_df[['genre', 'source', 'fragment']],
-                  on=['source', 'fragment'], how='left')
-    return df
+def get_centres(selectors):
+    """Return the vertical centre of each fragment selector."""
+    coords_df = get_selector_coords(selectors)
+    return coords_df['y'] + coords_df['h'] / 2.0
 
 
-def merge_dates_df(df, dates_df):
-    """Merge the dates by matching on source."""
-    df = df.merge(dates_df[['date', 'source', 'task_id']], on='source',
-                  how='left', suffixes=('_title', '_date'))
-    return df
+def add_centre_column(df, task_lookup_df=None):
+    """Add the vertical centre of each fragment selector to the dataframe.
 
+    Where a selector cannot be parsed the fragment of the related task is
+    used, and failing that the top of the sheet, so that no rows are lost.
+    """
+    centres = get_centres(df['selector'])
+    missing = centres.isnull()
+    if missing.any():
+        tasks_df = add_task_columns(df.loc[missing.values, ['task_id']],
+                                    ['fragment'], lookup_df=task_lookup_df)
+        fragments = tasks_df['fragment'].astype(str).str.split('xywh=')
+        centres[missing] = get_centres(fragments.str[-1]).values
+    return df.assign(centre=centres.fillna(0))
 
-def get_task_link(task_id, task_df):
-    """Get the link from the PYBOSSA task."""
-    try:
-        task = task_df.loc[int(task_id)]
-    except KeyError:
-        return None
-    return task['info']['link']
 
+def get_positions_df(df, columns, task_lookup_df=None):
+    """Return the sheet and centre of each fragment, sorted by centre."""
+    df = add_centre_column(df, task_lookup_df)
+    df = df.assign(sheet=df['source'].astype(object))
+    df = df.sort_values('centre', kind='mergesort')
+    return df[columns + ['sheet', 'centre']]
 
-def add_link(df):
-    """Add the link from one of the related tasks."""
-    tasks_df = get_pybossa_df('task')
-    df['link'] = df['task_id_title'].apply(get_task_link, args=(tasks_df,))
-    return df
 
+def get_title_dates(positions_df, dates_df, task_lookup_df=None):
+    """Return the date nearest to each title on its sheet.
 
-@CACHE.memoize(typed=True, expire=3600, tag='its_performances')
-def get_performances_df():
-    """Return a dataframe of performances."""
-    url = 'https://annotations.libcrowds.com/annotations/playbills-results/'
-    df = get_annotations_df(url)
-    df = add_fields(df)
+    A date at the top of a sheet is shared by all of the titles below it.
+    The result is indexed by the title ID.
+    """
+    date_positions_df = get_positions_df(dates_df, ['date'], task_lookup_df)
+    linked_df = pd.merge_asof(positions_df, date_positions_df, on='centre',
+                              by='sheet', direction='nearest')
+    return linked_df.set_index('id')[['date']]
+
+
+def link_to_titles(positions_df, df, tag, task_lookup_df=None):
+    """Return the values of a tag linked to the nearest title on each sheet.
+
+    The positions of the titles are given, as they are shared by each tag.
+    The result is indexed by the title ID, with a row for each value.
+    """
+    tag_positions_df = get_positions_df(df, [tag], task_lookup_df)
+    linked_df = pd.merge_asof(tag_positions_df, positions_df, on='centre',
+                              by='sheet', direction='nearest')
+    linked_df = linked_df[linked_df['id'].notnull()]
+    return linked_df.set_index('id')[[tag]]
+
+
+def merge_linked_df(df, positions_df, tag_df, tag, task_lookup_df=None):
+    """Merge the values of a tag linked to each title."""
+    linked_df = link_to_titles(positions_df, tag_df, tag, task_lookup_df)
+    return df.merge(linked_df, left_on='id', right_index=True, how='left')
+
+
+def build_performances_df(df, volume_md_df, task_lookup_df=None):
+    """Return a dataframe of performances from the normalised annotations.
+
+    The shared task lookup table is used unless another is given. Rows are
+    sorted by sheet, so the result does not depend on how the annotations
+    were split into shards.
+    """
     df = df[df['motivation'] == 'describing']
 
     titles_df = get_df_from_tag(df, 'title')
     dates_df = get_df_from_tag(df, 'date')
     genres_df = get_df_from_tag(df, 'genre')
 
-    df = titles_df
-    df = merge_dates_df(df, dates_df)
-    df = merge_genres_df(df, genres_df)
-    df = add_volume_metadata(df)
-    df = add_link(df)
+    positions_df = get_positions_df(titles_df, ['id'], task_lookup_df)
+    df = add_task_columns(titles_df, ['link'], lookup_df=task_lookup_df)
+    df = df.merge(get_title_dates(positions_df, dates_df, task_lookup_df),
+                  left_on='id', right_index=True, how='left')
+    df = merge_linked_df(df, positions_df, genres_df, 'genre',
+                         task_lookup_df)
+    df = add_volume_metadata(df, volume_md_df)
     df = df[['title', 'date', 'genre', 'link', 'theatre', 'city', 'source']]
-    df.drop_duplicates(inplace=True)
-    return df
+    df = df.drop_duplicates()
+    return df.sort_values('source', kind='mergesort').reset_index(drop=True)
+
+
+def get_inputs_fingerprint():
+    """Return a fingerprint of the inputs used to build the performances."""
+    return (
+        VERSION,
+        get_collection_fingerprint(PLAYBILLS_URL),
+        get_max_id('task'),
+        hash_file(get_volumes_path())
+    )
+
+
+@fingerprints.memoize(get_inputs_fingerprint, tag='its_performances')
+def get_performances_df():
+    """Return a dataframe of performances."""
+    df = get_normalised_df(PLAYBILLS_URL)
+    return build_performances_df(df, get_volumes_df())
 
 
 @click.command()
 def main():
     df = get_performances_df()
-    write_to_csv(df, 'data', 'its', 'performances.csv')
+    write_output(df, 'data', 'its', 'performances.csv')
 
 
 if __name__ == "__main__":
@@ -2,51 +2,74 @@
 """
 Output results as a row per playbill.
 """
-import tqdm
 import click
 import pandas
-import flatten_json
 
-from get_annotations import get_annotations_df
-from helpers import write_to_csv, get_tag, get_transcription, get_source
+from normalise import get_normalised_df, PLAYBILLS_URL
+from output import write_output
 from helpers import get_volumes_df
 
 
-def add_fields(df):
-    """Add fields to the dataframe."""
-    df['tag'] = df['body'].apply(get_tag)
-    df['transcription'] = df['body'].apply(get_transcription)
-    df['source'] = df['target'].apply(get_source)
-    return df
+def get_entities_df(df):
+    """Return the distinct values of each tag, numbered within each sheet.
+
+    Each value is given a column name such as `date_0`, `date_1`, and so on.
+    Tags that were used on a sheet without any values are given a single
+    column containing an empty list, named after the tag itself.
+    """
+    has_value = df['transcription'].notnull() & \
+        df['transcription'].astype(bool)
+    values_df = df[has_value].drop_duplicates(['source', 'tag',
+                                               'transcription'])
+    entity_n = values_df.groupby(['source', 'tag']).cumcount()
+    values_df = values_df.assign(
+        column=values_df['tag'].astype(str) + '_' + entity_n.astype(str)
+    )
+
+    empty_df = df[['source', 'tag']].drop_duplicates()
+    empty_df = empty_df.merge(values_df[['source', 'tag']].drop_duplicates(),
+                              how='left', indicator=True)
+    empty_df = empty_df[empty_df['_merge'] == 'left_only']
+    empty_df = empty_df.assign(column=empty_df['tag'].astype(str),
+                               transcription=[[] for _ in empty_df.index])
+
+    entities_df = pandas.concat([values_df, empty_df], sort=False)
+    return entities_df.set_index(['source', 'column'])['transcription']
+
+
+def build_sheets_df(df, vol_md_df):
+    """Return all data for each sheet from the normalised annotations."""
+    df = df[(df['motivation'] == 'describing') & df['tag'].notnull()]
+    wide_df = get_entities_df(df).unstack()
+    wide_df.columns.name = None
+
+    # Keep system numbers as integers for manifests missing from the sheet
+    sys_nos = vol_md_df['system_number']
+    if sys_nos.dtype.kind in 'iu':
+        sys_nos = sys_nos.astype('Int64')
+
+    sheets_df = df.drop_duplicates('source')[['source', 'partOf']]
+    sheets_df = sheets_df.merge(sys_nos.to_frame(), left_on='partOf',
+                                right_index=True, how='left')
+    sheets_df = sheets_df.rename(columns={
+        'source': 'id',
+        'system_number': 'sys_no'
+    })
+    out_df = sheets_df[['id', 'sys_no']].join(wide_df, on='id')
+    out_df = out_df.sort_values('id').reset_index(drop=True)
+    return out_df[sorted(out_df.columns)]
 
 
 def get_sheets_df():
     """Return the all data for each sheet."""
-    url = 'https://annotations.libcrowds.com/annotations/playbills-results/'
-    df = get_annotations_df(url)
-    df = add_fields(df)
-    df = df[df['motivation'] == 'describing']
-    groups = df.groupby('source', as_index=False)
-    vol_md_df = get_volumes_df()
-    out_data = []
-    for source, group_df in tqdm.tqdm(groups, desc='Processing', unit='item'):
-        manifest_uri = group_df['partOf'].tolist()[0]
-        group_df = group_df.pivot(columns='tag', values='transcription')
-        row = {c: list(set([v for v in group_df[c].tolist()
-                            if v and not pandas.isnull(v)]))
-               for c in group_df.columns}
-        row['id'] = source
-        row['sys_no'] = vol_md_df.loc[manifest_uri].to_dict()['system_number']
-        flat_row = flatten_json.flatten(row)
-        out_data.append(flat_row)
-    out_df = pandas.DataFrame(out_data)
-    return out_df
+    df = get_normalised_df(PLAYBILLS_URL)
+    return build_sheets_df(df, get_volumes_df())
 
 
 @click.command()
 def main():
     df = get_sheets_df()
-    write_to_csv(df, 'data', 'its', 'sheets.csv')
+    write_output(df, 'data', 'its', 'sheets.csv')
 
 
 if __name__ == "__main__":
@@ -1,13 +1,27 @@
 #-*- coding: utf-8 -*-
 """
 Generate #onthisday tweets from In the Spotlight data.
+
+Each time the tweets are generated they are also stored in an index, keyed
+by month and day, so that today's tweets can be looked up without building
+the performances again. The index is saved with a fingerprint of the inputs
+to the performances, and is built again when they change.
 """
+import os
+import time
 import click
 import pandas
 import datetime
 
-from get_its_performances import get_performances_df
-from helpers import write_to_csv
+from fingerprints import is_reliable
+from get_its_performances import get_performances_df, get_inputs_fingerprint
+from output import write_output
+from helpers import save_pickle, load_pickle, CACHE
+
+
+COLUMNS = ['day', 'month', 'year', 'tweet']
+
+DATE_PATTERN = r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
 
 
 def filter_incomplete_dates(df):
@@ -18,52 +32,107 @@ def filter_incomplete_dates(df):
 
 def add_date_parts(df):
     """Add day, month and year columns to the dataframe."""
-    df['date'] = pandas.to_datetime(df['date'])
-    df['day'] = df['date'].dt.strftime('%d')
-    df['month'] = df['date'].dt.strftime('%m')
-    df['year'] = df['date'].dt.strftime('%Y')
-    return df
+    parts_df = df['date'].str.extract(DATE_PATTERN, expand=True)
+    return df.assign(day=parts_df['day'], month=parts_df['month'],
+                     year=parts_df['year'])
 
 
-def filter_by_today(df):
-    """Filter out those rows that are not for today's day and month."""
+def add_tweets(df):
+    """Add a column containing the tweet for each row."""
+    tweets = ('#Onthisday, in ' + df['year'] + ', ' +
+              df['title'].astype(str) + ' was performed at ' +
+              df['theatre'].astype(str) + ' ' + df['link'].astype(str))
+    return df.assign(tweet=tweets)
+
+
+def build_tweets_df(df):
+    """Return the tweets for each complete date in the performances."""
+    df = filter_incomplete_dates(df)
+    df = add_date_parts(df)
+    df = add_tweets(df)
+    df = df.sort_values(['month', 'day'], kind='mergesort')
+    return df[COLUMNS]
+
+
+def get_index_path():
+    """Return the path to the tweets index."""
+    return os.path.join(CACHE.directory, 'its', 'tweets-index.pkl')
+
+
+def save_tweets_index(df, fingerprint=None):
+    """Save the tweets for each month and day to the index.
+
+    The fingerprint of the inputs to the performances is saved with it.
+    """
+    index = {}
+    for key, group_df in df.groupby(['month', 'day'], sort=False):
+        index[key] = list(zip(group_df['year'], group_df['tweet']))
+    save_pickle({
+        'fingerprint': fingerprint,
+        'saved': time.time(),
+        'tweets': index
+    }, get_index_path())
+    return index
+
+
+def load_tweets_index(fingerprint):
+    """Return the saved tweets index, if it is still up to date.
+
+    If the inputs cannot be checked a saved index is still used, with a
+    warning of its age. Returns None if the index must be built.
+    """
+    stored = load_pickle(get_index_path())
+    if not isinstance(stored, dict) or 'tweets' not in stored:
+        return None
+    if not is_reliable(fingerprint):
+        hours = (time.time() - stored['saved']) / 3600
+        print('Could not check the inputs, using tweets indexed '
+              '{:.0f} hours ago'.format(hours))
+        return stored['tweets']
+    if stored['fingerprint'] != fingerprint:
+        return None
+    return stored['tweets']
+
+
+def get_todays_tweets_df():
+    """Return today's tweets from the index, building it if out of date."""
+    fingerprint = get_inputs_fingerprint()
+    index = load_tweets_index(fingerprint)
+    if index is None:
+        index = save_tweets_index(build_tweets_df(get_performances_df()),
+                                  fingerprint)
+
     ts = datetime.datetime.now()
     day = str(ts.day).zfill(2)
     month = str(ts.month).zfill(2)
-    df = df[df['month'] == month]
-    df = df[df['day'] == day]
-    return df
-
-
-def get_tweet(row):
-    """Return a tweet for the given row."""
-    return '#Onthisday, in {0}, {1} was performed at {2} {3}'.format(row['year'], row['title'], row['theatre'], row['link'])
+    rows = [(day, month, year, tweet)
+            for year, tweet in index.get((month, day), [])]
+    return pandas.DataFrame(rows, columns=COLUMNS)
 
 
-def get_tweets_df(today=False):
-    """Return In the Spotlight tweets in a dataframe."""
-    df = get_performances_df()
-    df = filter_incomplete_dates(df)
-    df = add_date_parts(df)
+def get_tweets_df(today=False, performances_df=None):
+    """Return In the Spotlight tweets in a dataframe.
 
+    Pass in the performances if they have already been built for this run.
+    """
     if today:
-        df = filter_by_today(df)
+        df = get_todays_tweets_df()
+    else:
+        if performances_df is None:
+            performances_df = get_performances_df()
+        df = build_tweets_df(performances_df)
+        save_tweets_index(df, get_inputs_fingerprint())
 
     if df.empty:
         print("There is not enough data to produce #onthisday tweets")
-        df['tweet'] = None
-    else:
-        df['tweet'] = df.apply(lambda row: get_tweet(row), axis=1)
-
-    df.sort_values(['month', 'day'], inplace=True)
-    return df[['day', 'month', 'year', 'tweet']]
+    return df
 
 
 @click.command()
 @click.option('--today', is_flag=True, default=False)
 def main(today):
     df = get_tweets_df(today)
-    write_to_csv(df, 'data', 'its', 'tweets.csv')
+    write_output(df, 'data', 'its', 'tweets.csv')
 
 
 if __name__ == "__main__":
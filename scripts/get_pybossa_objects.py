@@ -12,23 +12,45 @@ python scripts/get_pybossa_objects.py <domain_object>
 ```
 
 The CSV file will be saved to `data/{domain_object}.csv`.
+
+Several domain objects can be given at once, in which case they are
+downloaded concurrently, sharing one progress bar.
+
+```
+python scripts/get_pybossa_objects.py project task result
+```
+
+When downloading tasks, the `--field` option can be given one or more times
+(e.g. `--field info.link`) to keep only those fields. Such tasks are kept in
+a local mirror (see `get_task_mirror_df`) that is updated incrementally on
+each run.
 """
-import tqdm
-import time
+import os
 import click
 import pandas
-import requests
-import datetime
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrument
+import http_client
+import columnar_cache
+import fingerprints
+from output import write_output
+from progress import Progress, shared_progress
+from helpers import save_pickle, load_pickle, CACHE, PYBOSSA_URL
 
-from helpers import write_to_csv, CACHE
 
+BASE_URL = PYBOSSA_URL.rstrip('/')
 
-BASE_URL = 'https://backend.libcrowds.com'
+TASK_FIELDS = ['project_id', 'info.link', 'info.target.selector.value']
+
+DEFAULT_WORKERS = 4
 
 
 def get_objects(obj, offset=0):
     """Get a set of domain objects."""
-    r = requests.get(BASE_URL + '/api/{}'.format(obj), params={
+    r = http_client.get(BASE_URL + '/api/{}'.format(obj), params={
         'offset': offset,
         'limit': 100,
         'all': 1
@@ -37,48 +59,196 @@ def get_objects(obj, offset=0):
     return r
 
 
+@functools.lru_cache(maxsize=None)
+def get_max_id(obj):
+    """Return the highest ID of a domain object, probed once per run."""
+    r = http_client.get(BASE_URL + '/api/{}'.format(obj), params={
+        'limit': 1,
+        'orderby': 'id',
+        'desc': 'true',
+        'all': 1
+    })
+    r.raise_for_status()
+    data = r.json()
+    return data[0]['id'] if data else 0
+
+
+def get_objects_after(obj, last_id=0, **filters):
+    """Get the set of domain objects following an ID."""
+    params = dict(filters, last_id=last_id, limit=100, all=1)
+    r = http_client.get(BASE_URL + '/api/{}'.format(obj), params=params)
+    r.raise_for_status()
+    return r
+
+
 def _not_exhausted(last_fetched):
     """Check if the last fetched tasks were the last available."""
     return len(last_fetched) == 100
 
 
-def respect_rate_limits(response, progress):
-    """If we have exceeded the rate limit sleep until it is refreshed."""
-    reset = response.headers['x-ratelimit-reset']
-    reset_dt = datetime.datetime.fromtimestamp(float(reset))
-    remaining = response.headers['x-ratelimit-remaining']
-    if remaining == 0:
-        progress.write('Sleeping until rate limit refreshed, please wait...')
-        while reset_dt > datetime.datetime.now():
-            time.sleep(1)
-
-
-@CACHE.memoize(typed=True, expire=3600, tag='pybossa')
-def get_pybossa_df(obj):
-    """Load all of the chosen domain objects into a dataframe and return."""
-    progress = tqdm.tqdm(desc='Downloading', unit=obj)
+def download_pybossa_df(obj):
+    """Download all of the chosen domain objects into a dataframe."""
+    progress = Progress('Downloading', obj)
     r = get_objects(obj)
     last_fetched = r.json()
     data = last_fetched
     progress.update(len(last_fetched))
-    respect_rate_limits(r, progress)
     while _not_exhausted(last_fetched):
         r = get_objects(obj, len(data))
         last_fetched = r.json()
         data += last_fetched
         progress.update(len(last_fetched))
-        respect_rate_limits(r, progress)
     progress.close()
     df = pandas.DataFrame(data)
     df.set_index('id', inplace=True, verify_integrity=True)
     return df
 
 
+@fingerprints.memoize(get_max_id, tag='pybossa')
+def _get_memoized_pybossa_df(obj):
+    """Return the domain objects, memoized in the default cache."""
+    return download_pybossa_df(obj)
+
+
+def get_pybossa_df(obj, columns=None):
+    """Load all of the chosen domain objects into a dataframe and return.
+
+    The cached objects are reused until the highest ID changes. If the
+    columnar cache backend is enabled the objects are stored as
+    Parquet, partitioned by project where possible, and only the given
+    columns are loaded from disk.
+    """
+    if not columnar_cache.enabled():
+        df = _get_memoized_pybossa_df(obj)
+        return df[columns] if columns else df
+
+    name = 'pybossa/{}'.format(obj)
+    metadata = columnar_cache.load_metadata(name)
+    max_id = get_max_id(obj)
+    if metadata is None or metadata.get('max_id') != max_id:
+        instrument.count(cache_misses=1)
+        df = download_pybossa_df(obj)
+        partition_col = 'project_id' if 'project_id' in df.columns else None
+        columnar_cache.write_dataset(name, df, partition_col, max_id=max_id)
+    else:
+        instrument.count(cache_hits=1)
+    return columnar_cache.read_dataset(name, columns)
+
+
+def get_field(obj, path):
+    """Return the value at a dotted path into a domain object."""
+    for key in path.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def project_fields(objects, fields):
+    """Return the domain objects reduced to the chosen fields."""
+    return [dict([('id', o['id'])] + [(f, get_field(o, f)) for f in fields])
+            for o in objects]
+
+
+def get_mirror_path(obj, fields):
+    """Return the path to the local mirror of some domain objects."""
+    key = hashlib.md5(','.join(fields).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE.directory, 'pybossa',
+                        '{0}-{1}.pkl'.format(obj, key))
+
+
+def mirror_project_objects(obj, project_id, last_id, fields, progress):
+    """Return the chosen fields of a project's objects following an ID."""
+    r = get_objects_after(obj, last_id, project_id=project_id)
+    last_fetched = r.json()
+    data = project_fields(last_fetched, fields)
+    progress.update(len(last_fetched))
+    while _not_exhausted(last_fetched):
+        r = get_objects_after(obj, last_fetched[-1]['id'],
+                              project_id=project_id)
+        last_fetched = r.json()
+        data += project_fields(last_fetched, fields)
+        progress.update(len(last_fetched))
+    return data
+
+
+def get_task_mirror_df(fields=TASK_FIELDS, workers=DEFAULT_WORKERS):
+    """Update the local mirror of tasks and return it as a dataframe.
+
+    Tasks are paged by ID, rather than by offset, with the projects fetched in
+    parallel. Only tasks newer than the highest ID already stored for each
+    project are downloaded.
+    """
+    fields = sorted(set(fields) | set(['project_id']))
+    path = get_mirror_path('task', fields)
+    df = load_pickle(path)
+    high_water_marks = {}
+    if df is not None:
+        high_water_marks = df.reset_index().groupby('project_id')['id'].max()
+
+    project_ids = get_pybossa_df('project').index.tolist()
+    progress = Progress('Mirroring', 'task')
+    mirror = instrument.bind(mirror_project_objects)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(mirror, 'task', project_id,
+                                   int(high_water_marks.get(project_id, 0)),
+                                   fields, progress)
+                   for project_id in project_ids]
+        data = [row for future in futures for row in future.result()]
+    progress.close()
+
+    if df is None or data:
+        new_df = pandas.DataFrame(data, columns=['id'] + fields)
+        new_df.set_index('id', inplace=True)
+        df = pandas.concat([df, new_df], sort=False)
+        df = df[~df.index.duplicated(keep='last')].sort_index()
+        save_pickle(df, path)
+    return df
+
+
+def get_output_df(obj, fields=None):
+    """Return the domain objects to be saved, with only the chosen fields.
+
+    Fields can only be chosen for tasks.
+    """
+    if fields and obj == 'task':
+        return get_task_mirror_df(fields)
+    return get_pybossa_df(obj)
+
+
+def save_objects(objs, fields=None):
+    """Download several domain objects at once and save each to a file.
+
+    The objects share the pooled connections and rate limits of the HTTP
+    client, and one progress bar. The task mirror needs the projects, so
+    these are fetched first, once, rather than twice at the same time.
+    Objects named more than once are refused before anything is downloaded.
+    """
+    objs = list(objs)
+    duplicates = sorted(set(obj for obj in objs if objs.count(obj) > 1))
+    if duplicates:
+        raise ValueError('Objects would be saved to the same file: '
+                         '{}'.format(', '.join(duplicates)))
+    with shared_progress('Downloading'):
+        if fields and 'task' in objs:
+            projects_df = get_pybossa_df('project')
+            if 'project' in objs:
+                objs.remove('project')
+                write_output(projects_df, 'data', 'project.csv')
+        with ThreadPoolExecutor(max_workers=len(objs)) as executor:
+            futures = dict((executor.submit(get_output_df, obj, fields), obj)
+                           for obj in objs)
+            for future in as_completed(futures):
+                obj = futures[future]
+                write_output(future.result(), 'data', '{}.csv'.format(obj))
+
+
 @click.command()
-@click.argument('obj')
-def main(obj):
-    df = get_pybossa_df(obj)
-    write_to_csv(df, 'data', '{}.csv'.format(obj))
+@click.argument('objs', nargs=-1, required=True)
+@click.option('--field', '-f', multiple=True,
+              help='Task field to keep, such as info.link (tasks only).')
+def main(objs, field):
+    save_objects(objs, field)
 
 
 if __name__ == '__main__':
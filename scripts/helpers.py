@@ -9,7 +9,21 @@ import pandas
 from diskcache import FanoutCache
 
 
-CACHE = FanoutCache('../cache')
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+CACHE_DIR = os.path.abspath(os.environ.get('LIBCROWDS_CACHE_DIR',
+                                           os.path.join(os.path.dirname(HERE),
+                                                        'cache')))
+
+CACHE = FanoutCache(CACHE_DIR)
+
+CACHE_BACKEND = os.environ.get('LIBCROWDS_CACHE_BACKEND', 'pickle')
+
+ANNOTATIONS_URL = os.environ.get('LIBCROWDS_ANNOTATIONS_URL',
+                                 'https://annotations.libcrowds.com')
+
+PYBOSSA_URL = os.environ.get('LIBCROWDS_PYBOSSA_URL',
+                             'https://backend.libcrowds.com')
 
 
 def mkdirs(path):
@@ -21,15 +35,19 @@ def mkdirs(path):
             raise
 
 
-def write_to_csv(df, *path_parts):
-    """Save a dataframe to CSV."""
-    here = os.path.abspath(os.path.dirname(__file__))
-    _dir = os.path.join(os.path.dirname(here), *path_parts[:-1])
-    fn = path_parts[-1]
-    mkdirs(_dir)
-    out_path = os.path.join(_dir, fn)
-    df.to_csv(out_path, encoding='utf-8', index=False)
-    print('CSV file saved to {}'.format(out_path))
+def save_pickle(obj, path):
+    """Pickle an object to a file, replacing any existing file atomically."""
+    mkdirs(os.path.dirname(path))
+    tmp_path = '{}.tmp'.format(path)
+    pandas.to_pickle(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_pickle(path):
+    """Load a pickled object from a file, or return None if it is missing."""
+    if not os.path.exists(path):
+        return None
+    return pandas.read_pickle(path)
 
 
 def get_tag(body):
@@ -66,12 +84,33 @@ def get_task_id(generator):
             return g['id'].split('/')[-1]
 
 
+def get_fragment_selector(target):
+    """Return the fragment selector coordinates, if the target has any."""
+    if not isinstance(target, dict):
+        return None
+    value = target.get('selector', {}).get('value')
+    if not value:
+        return None
+    return value.lstrip('?xywh=')
+
+
+def get_lark(part_of):
+    """Return the logical ARK."""
+    if not isinstance(part_of, str) or '/iiif/' not in part_of:
+        return None
+    tmp = part_of.rstrip('/manifest.json')
+    return tmp.split('/iiif/')[1]
+
+
+def get_volumes_path():
+    """Return the path to the volume metadata file."""
+    here = os.path.abspath(os.path.dirname(__file__))
+    return os.path.join(os.path.dirname(here), 'metadata', 'its_volumes.csv')
+
+
 def get_volumes_df():
     """Return a dataframe containing metadata for each volume."""
-    here = os.path.abspath(os.path.dirname(__file__))
-    in_path = os.path.join(os.path.dirname(here), 'metadata',
-                           'its_volumes.csv')
-    df = pandas.read_csv(in_path)
+    df = pandas.read_csv(get_volumes_path())
     df.set_index('manifest_uri', inplace=True, verify_integrity=True)
     return df
 
@@ -86,3 +125,16 @@ def normalise_shelfmark(sm):
     sm = sm.replace('&', ' & ')
     sm = re.sub(r'(\d+)', lambda m: m.group(1).rjust(7, ' '), sm)
     return sm.upper()
+
+
+def normalise_shelfmarks(series):
+    """Normalize a series of shelfmarks, as with normalise_shelfmark."""
+    s = series.str.replace(r'\s+', r'', regex=True)
+    s = s.str.replace(r',|\.|;|:', r'', regex=True)
+    s = s.str.replace(r'\[|\{', r'\(', regex=True)
+    s = s.str.replace(r'\]|\}', r'\)', regex=True)
+    s = s.str.replace('_', '-', regex=False)
+    s = s.str.replace('&', ' & ', regex=False)
+    s = s.str.replace(r'(\d+)', lambda m: m.group(1).rjust(7, ' '),
+                      regex=True)
+    return s.str.upper()
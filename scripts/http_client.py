@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+A shared HTTP client for the LibCrowds servers.
+
+All requests go through one session, so connections are pooled and kept
+alive between requests, and responses are gzip compressed where supported.
+Requests time out rather than hanging, and connection errors and temporary
+server errors are retried with jittered exponential backoff.
+
+The `x-ratelimit-*` headers returned by each host are used to fill a token
+bucket for that host. When the tokens run out, requests wait until the rate
+limit is reset. The number of requests, retries and bytes received, and the
+time spent waiting on the rate limit, are counted per host (see
+`get_stats`). Listeners can also be told of each count as it is made, in
+the thread that made the request (see `add_listener`).
+"""
+import time
+import random
+import threading
+import collections
+import tqdm
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+
+TIMEOUT = (10, 60)
+
+MAX_RETRIES = 5
+
+BACKOFF_FACTOR = 0.5
+
+POOL_SIZE = 32
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+_session = None
+
+_session_lock = threading.Lock()
+
+_limiters = {}
+
+_stats = collections.defaultdict(collections.Counter)
+
+_stats_lock = threading.Lock()
+
+_listeners = []
+
+
+class RateLimiter(object):
+    """A token bucket for a host, filled from its rate limit headers.
+
+    Until the host returns rate limit headers requests are not limited.
+    """
+
+    def __init__(self):
+        self.tokens = None
+        self.limit = None
+        self.reset_at = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Take a token, waiting until the limit is reset if none are left.
+
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0
+        with self.condition:
+            while self.tokens is not None and self.tokens <= 0:
+                delay = self.reset_at - time.time()
+                if delay <= 0:
+                    self.tokens = self.limit
+                    break
+                if not waited:
+                    tqdm.tqdm.write('Sleeping until rate limit refreshed, '
+                                    'please wait...')
+                start = time.time()
+                self.condition.wait(delay)
+                waited += time.time() - start
+            if self.tokens is not None:
+                self.tokens -= 1
+        return waited
+
+    def update(self, headers):
+        """Refill the bucket from the rate limit headers of a response."""
+        try:
+            remaining = int(headers['x-ratelimit-remaining'])
+            reset_at = float(headers['x-ratelimit-reset'])
+        except (KeyError, ValueError):
+            return
+        with self.condition:
+            self.tokens = remaining
+            self.reset_at = reset_at
+            limit = headers.get('x-ratelimit-limit')
+            self.limit = int(limit) if limit else None
+            self.condition.notify_all()
+
+
+def get_session():
+    """Return the shared session, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                                  pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _session = session
+        return _session
+
+
+def get_limiter(host):
+    """Return the rate limiter for a host."""
+    with _session_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter()
+        return _limiters[host]
+
+
+def add_listener(func):
+    """Call a function with the counts each time they are added to."""
+    _listeners.append(func)
+
+
+def count(host, **counts):
+    """Add to the counters for a host."""
+    with _stats_lock:
+        _stats[host].update(counts)
+    for func in _listeners:
+        func(**counts)
+
+
+def get_stats():
+    """Return the counters for each host."""
+    with _stats_lock:
+        return dict((host, dict(counter)) for host, counter in _stats.items())
+
+
+def reset_stats():
+    """Reset the counters for all hosts."""
+    with _stats_lock:
+        _stats.clear()
+
+
+def get_backoff(attempt, response=None):
+    """Return the delay before a retry, with jitter.
+
+    Any Retry-After header given with the response is respected.
+    """
+    if response is not None and response.headers.get('retry-after'):
+        try:
+            return float(response.headers['retry-after'])
+        except ValueError:
+            pass
+    return BACKOFF_FACTOR * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def get(url, params=None, timeout=TIMEOUT):
+    """Make a GET request and return the response.
+
+    Retries are made for connection errors, timeouts and temporary server
+    errors. The response is returned once successful, on any other error
+    status or after the last retry, so it should be checked by the caller.
+    """
+    host = urlparse(url).netloc
+    limiter = get_limiter(host)
+    session = get_session()
+    attempt = 0
+    while True:
+        waited = limiter.acquire()
+        try:
+            r = session.get(url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= MAX_RETRIES:
+                raise
+            count(host, errors=1, retries=1, throttled_seconds=waited)
+            time.sleep(get_backoff(attempt))
+            attempt += 1
+            continue
+
+        limiter.update(r.headers)
+        count(host, requests=1, bytes=len(r.content),
+              throttled_seconds=waited)
+        if r.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+            return r
+        count(host, retries=1)
+        time.sleep(get_backoff(attempt, r))
+        attempt += 1
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Track the records already created from Convert-a-Card results.
+
+The fields extracted from each `.lex` file saved to `metadata/convert-a-card`
+are cached along with the file's size, modification time and content hash,
+so only new or changed files are parsed again. The shelfmarks of all records
+are normalised into an index, which is stored in the cache and rebuilt
+whenever those files change. If run as a standalone
+script, using the command below, the index will be used to check whether
+records have already been created for the given shelfmarks.
+
+```
+python scripts/ingested.py <shelfmark> [<shelfmark> ...]
+```
+"""
+import os
+import click
+import pandas
+import functools
+from pymarc import MARCReader
+
+import instrument
+from helpers import normalise_shelfmark, normalise_shelfmarks
+from helpers import save_pickle, load_pickle, CACHE
+from fingerprints import hash_file
+
+
+def get_marc_file_paths():
+    """Return a list of paths to MARC metadata files."""
+    here = os.path.abspath(os.path.dirname(__file__))
+    path = os.path.join(os.path.dirname(here), 'metadata', 'convert-a-card')
+    return [os.path.join(path, fn) for fn in os.listdir(path)]
+
+
+def parse_marc_file(path):
+    """Return the fields extracted from each record in a MARC file."""
+    out = []
+    with open(path, 'rb') as f:
+        reader = MARCReader(f)
+        for record in reader:
+            out.append({
+                'language': record['008'].data[35:38],
+                'shelfmark': record['852']['j']
+            })
+    return pandas.DataFrame(out, columns=['language', 'shelfmark'])
+
+
+def get_marc_file_df(path):
+    """Return the fields extracted from a MARC file, parsing it if changed."""
+    stat = os.stat(path)
+    key = ('marc', os.path.abspath(path))
+    cached = CACHE.get(key)
+    if cached is not None and (cached['size'], cached['mtime']) == \
+            (stat.st_size, stat.st_mtime):
+        instrument.count(cache_hits=1)
+        return cached['df']
+
+    file_hash = hash_file(path)
+    if cached is None or cached['hash'] != file_hash:
+        instrument.count(cache_misses=1)
+        df = parse_marc_file(path)
+    else:
+        instrument.count(cache_hits=1)
+        df = cached['df']
+    CACHE.set(key, {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hash': file_hash,
+        'df': df
+    }, tag='marc')
+    return df
+
+
+@functools.lru_cache(maxsize=None)
+def get_ingested_df():
+    """Return a summary of records already created from Convert-a-Card.
+
+    The summary is built once per run and shared by all callers, so it
+    should not be modified in place.
+    """
+    return build_ingested_df(sorted(get_marc_file_paths()))
+
+
+def build_ingested_df(paths):
+    """Return a summary of the records in some MARC files."""
+    df = pandas.concat([get_marc_file_df(path) for path in paths],
+                       ignore_index=True)
+    df['normalised_shelfmark'] = normalise_shelfmarks(df['shelfmark'])
+    return df
+
+
+def get_marc_files_key():
+    """Return the path, size and modification time of each MARC file."""
+    key = []
+    for path in sorted(get_marc_file_paths()):
+        stat = os.stat(path)
+        key.append((os.path.basename(path), stat.st_size, stat.st_mtime))
+    return key
+
+
+def get_shelfmark_index():
+    """Return the set of normalised shelfmarks already ingested."""
+    path = os.path.join(CACHE.directory, 'cac', 'shelfmark-index.pkl')
+    key = get_marc_files_key()
+    stored = load_pickle(path)
+    if stored is not None and stored['key'] == key:
+        instrument.count(cache_hits=1)
+        return stored['index']
+
+    instrument.count(cache_misses=1)
+    ingested_df = get_ingested_df()
+    index = frozenset(ingested_df['normalised_shelfmark'])
+    save_pickle({'key': key, 'index': index}, path)
+    return index
+
+
+def is_ingested(shelfmark, index=None):
+    """Check if a record has already been created for a shelfmark."""
+    if index is None:
+        index = get_shelfmark_index()
+    return normalise_shelfmark(shelfmark) in index
+
+
+def filter_ingested(df, index=None):
+    """Return the rows whose shelfmarks are not in the index."""
+    if index is None:
+        index = get_shelfmark_index()
+    ingested = normalise_shelfmarks(df['shelfmark']).isin(index)
+    return df[~ingested]
+
+
+@click.command()
+@click.argument('shelfmarks', nargs=-1, required=True)
+def main(shelfmarks):
+    index = get_shelfmark_index()
+    for shelfmark in shelfmarks:
+        status = 'ingested' if is_ingested(shelfmark, index) else 'new'
+        print('{0}\t{1}'.format(shelfmark, status))
+
+
+if __name__ == '__main__':
+    main()
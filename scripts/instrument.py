@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Record what each stage of a run does and how long it takes.
+
+Code is wrapped in named stages, which record the wall and CPU time taken,
+the rows in and out, the cache hits and misses counted during the stage and
+the HTTP requests made and bytes received. A stage can also be run under
+cProfile.
+
+```python
+with instrument.stage('performances', rows_in=len(df)) as record:
+    out_df = build_performances_df(df, volumes_df)
+    record['rows_out'] = len(out_df)
+instrument.write_report('its')
+```
+
+Reports are saved as JSON to the `reports` directory. Counts, HTTP requests
+and CPU time are attributed to the stage running in the thread that made
+them, so stages run at the same time are measured apart. Work handed to other
+threads is attributed to the stage that handed it over if the function is
+wrapped with `bind`. Work done in other processes is not counted. The peak
+resident memory can only be measured for the whole process, so each record
+gives the process peak reached by the end of the stage.
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import datetime
+import functools
+import threading
+import contextlib
+import collections
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import http_client
+from helpers import mkdirs
+
+
+RUN_ID = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+
+STARTED = time.time()
+
+_records = []
+
+_counters = collections.defaultdict(collections.Counter)
+
+_lock = threading.Lock()
+
+_local = threading.local()
+
+
+def get_report_path(name, ext):
+    """Return the path to a report file for this run."""
+    here = os.path.abspath(os.path.dirname(__file__))
+    fn = '{0}-{1}.{2}'.format(RUN_ID, name, ext)
+    return os.path.join(os.path.dirname(here), 'reports', fn)
+
+
+def get_peak_rss():
+    """Return the peak resident memory of the process in bytes, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _get_stack():
+    """Return the names of the stages running in this thread."""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def count(**counts):
+    """Add to the counters of the stage running in this thread.
+
+    Counts made outside of any stage are recorded against None.
+    """
+    stack = _get_stack()
+    name = stack[-1] if stack else None
+    with _lock:
+        _counters[name].update(counts)
+
+
+def count_http(**counts):
+    """Count the HTTP requests made and bytes received in this thread."""
+    if counts.get('requests') or counts.get('bytes'):
+        count(http_requests=counts.get('requests', 0),
+              http_bytes=counts.get('bytes', 0))
+
+
+http_client.add_listener(count_http)
+
+
+def bind(func):
+    """Return a function that runs in the stages of the calling thread.
+
+    Wrap functions passed to worker threads, such as those downloading
+    pages, so that their requests and CPU time are counted against the
+    stage that started them.
+    """
+    stack = list(_get_stack())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = _get_stack()
+        _local.stack = list(stack)
+        cpu_start = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            count(cpu_seconds=time.thread_time() - cpu_start)
+            _local.stack = outer
+    return wrapper
+
+
+def add_record(name, **fields):
+    """Record a stage that was not run, such as one that was skipped."""
+    with _lock:
+        _records.append(dict(fields, stage=name))
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, profile=False):
+    """Record a stage of a run.
+
+    The record is yielded so that the rows out, or any other fields, can be
+    added. If `profile` is True the stage is run under cProfile and the
+    stats are saved to the reports directory.
+    """
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    with _lock:
+        counts_before = collections.Counter(_counters[name])
+    profiler = cProfile.Profile() if profile else None
+    stack = _get_stack()
+    stack.append(name)
+    wall_start = time.time()
+    cpu_start = time.thread_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+            path = get_report_path(name, 'prof')
+            mkdirs(os.path.dirname(path))
+            profiler.dump_stats(path)
+            record['profile'] = path
+        stack.pop()
+        with _lock:
+            counts = _counters[name] - counts_before
+        record.update({
+            'wall_seconds': time.time() - wall_start,
+            'cpu_seconds': (time.thread_time() - cpu_start +
+                            counts.get('cpu_seconds', 0)),
+            'process_peak_rss_bytes': get_peak_rss(),
+            'cache_hits': counts.get('cache_hits', 0),
+            'cache_misses': counts.get('cache_misses', 0),
+            'http_requests': counts.get('http_requests', 0),
+            'http_bytes': counts.get('http_bytes', 0)
+        })
+        with _lock:
+            _records.append(record)
+
+
+def get_records():
+    """Return the records of the stages run so far."""
+    with _lock:
+        return list(_records)
+
+
+def write_report(name, **extra):
+    """Save a report of the stages run so far and return its path."""
+    path = get_report_path(name, 'json')
+    mkdirs(os.path.dirname(path))
+    with _lock:
+        unattributed = dict(_counters[None])
+    report = dict(extra, **{
+        'name': name,
+        'run_id': RUN_ID,
+        'wall_seconds': time.time() - STARTED,
+        'peak_rss_bytes': get_peak_rss(),
+        'stages': get_records(),
+        'http': http_client.get_stats(),
+        'unattributed_counts': unattributed
+    })
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+    print('Run report saved to {}'.format(path))
+    return path
@@ -1,29 +1,105 @@
 #-*- coding: utf-8 -*-
 """
 Generate In the Spotlight data.
+
+Outputs are only produced again when their inputs have changed since the
+last run. Use `--only` to choose outputs, `--jobs` to set how many stages
+run at once and `--force` to produce all outputs regardless. Use `--delta`
+to also export the rows added, changed and removed since the last export,
+and `--profile` to save a report of the time and resources used by each
+stage to the `reports` directory.
+
+Use `--shards` to split the annotations into a shard per manifest and build
+the outputs from the shards in parallel worker processes (see `shards.py`),
+so that memory use is bounded by the largest manifest.
 """
 import click
+import functools
 
-from get_its_performances import get_performances_df
+import instrument
+from get_its_performances import build_performances_df
+from get_its_performances import VERSION as PERFORMANCES_VERSION
 from get_its_tweets import get_tweets_df
-from get_its_title_index import get_title_index_df
-from get_its_sheets import get_sheets_df
-from helpers import write_to_csv
+from get_its_title_index import build_title_index_df
+from get_its_sheets import build_sheets_df
+from normalise import get_normalised_df, PLAYBILLS_URL
+from lookups import get_task_lookup_df
+from shards import get_shards, build_sharded_df, shutdown_pool
+from pipeline import Stage, run_pipeline
+from helpers import get_volumes_df
 
 
-@click.command()
-def main():
-    performances_df = get_performances_df()
-    write_to_csv(performances_df, 'data', 'its', 'performances.csv')
+STAGES = [
+    Stage('annotations', lambda: get_normalised_df(PLAYBILLS_URL)),
+    Stage('tasks', get_task_lookup_df),
+    Stage('volumes', get_volumes_df),
+    Stage('performances', build_performances_df,
+          inputs=['annotations', 'volumes', 'tasks'],
+          output=('data', 'its', 'performances.csv'),
+          version=PERFORMANCES_VERSION),
+    Stage('title-index', build_title_index_df,
+          inputs=['annotations'],
+          output=('data', 'its', 'title-index.csv')),
+    Stage('tweets', lambda df: get_tweets_df(performances_df=df),
+          inputs=['performances'],
+          output=('data', 'its', 'tweets.csv')),
+    Stage('sheets', build_sheets_df,
+          inputs=['annotations', 'volumes'],
+          output=('data', 'its', 'sheets.csv'), key='id')
+]
 
-    title_index_df = get_title_index_df()
-    write_to_csv(title_index_df, 'data', 'its', 'title-index.csv')
+SHARDED_STAGES = [
+    Stage('shards', lambda: get_shards(PLAYBILLS_URL)),
+    Stage('tasks', get_task_lookup_df),
+    Stage('volumes', get_volumes_df),
+    Stage('performances',
+          functools.partial(build_sharded_df, 'performances'),
+          inputs=['shards', 'volumes', 'tasks'],
+          output=('data', 'its', 'performances.csv'),
+          version=PERFORMANCES_VERSION),
+    Stage('title-index', functools.partial(build_sharded_df, 'title-index'),
+          inputs=['shards'],
+          output=('data', 'its', 'title-index.csv')),
+    Stage('tweets', lambda df: get_tweets_df(performances_df=df),
+          inputs=['performances'],
+          output=('data', 'its', 'tweets.csv')),
+    Stage('sheets', functools.partial(build_sharded_df, 'sheets'),
+          inputs=['shards', 'volumes'],
+          output=('data', 'its', 'sheets.csv'), key='id')
+]
 
-    tweets_df = get_tweets_df()
-    write_to_csv(tweets_df, 'data', 'its', 'tweets.csv')
+OUTPUTS = [stage.name for stage in STAGES if stage.output]
 
-    sheets_df = get_sheets_df()
-    write_to_csv(sheets_df, 'data', 'its', 'sheets.csv')
+STAGE_NAMES = sorted(set(stage.name for stage in STAGES + SHARDED_STAGES))
+
+
+@click.command()
+@click.option('--only', multiple=True, type=click.Choice(OUTPUTS),
+              help='Only produce the chosen outputs.')
+@click.option('--jobs', default=4, show_default=True,
+              help='Maximum number of stages to run at once.')
+@click.option('--force', is_flag=True, default=False,
+              help='Produce outputs even if their inputs have not changed.')
+@click.option('--delta', is_flag=True, default=False,
+              help='Also export the rows changed since the last export.')
+@click.option('--profile', is_flag=True, default=False,
+              help='Save a report of the time and resources used by stages.')
+@click.option('--profile-stage', default=None,
+              type=click.Choice(STAGE_NAMES),
+              help='Also save cProfile stats for the chosen stage.')
+@click.option('--shards', is_flag=True, default=False,
+              help='Build outputs from a shard per manifest, in parallel.')
+def main(only, jobs, force, delta, profile, profile_stage, shards):
+    if shards:
+        try:
+            run_pipeline(SHARDED_STAGES, only, jobs, force, delta,
+                         profile_stage)
+        finally:
+            shutdown_pool()
+    else:
+        run_pipeline(STAGES, only, jobs, force, delta, profile_stage)
+    if profile or profile_stage:
+        instrument.write_report('its')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Flat lookup tables for enriching results with PYBOSSA task and project data.
+
+The tasks and projects are flattened into one table, indexed by integer task
+ID, which is built once per run. Results are then enriched with bulk merges
+rather than per-row lookups.
+"""
+import functools
+
+from get_pybossa_objects import get_pybossa_df, get_task_mirror_df
+
+
+TASK_COLUMNS = {
+    'info.link': 'link',
+    'info.target.selector.value': 'fragment'
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_task_lookup_df():
+    """Return the link, fragment, project ID and project name of each task.
+
+    The table is shared by all callers within a run, so it should not be
+    modified in place.
+    """
+    tasks_df = get_task_mirror_df(sorted(TASK_COLUMNS))
+    projects_df = get_pybossa_df('project', columns=['name'])
+    return build_task_lookup_df(tasks_df, projects_df)
+
+
+def build_task_lookup_df(tasks_df, projects_df):
+    """Return the task lookup table from the task and project tables."""
+    df = tasks_df.rename(columns=TASK_COLUMNS)
+    df = df.merge(projects_df.rename(columns={'name': 'project'}),
+                  left_on='project_id', right_index=True, how='left')
+    df.index = df.index.astype('int64')
+    df.index.name = 'task_id'
+    return df[['link', 'fragment', 'project_id', 'project']]
+
+
+def add_task_columns(df, columns, on='task_id', lookup_df=None):
+    """Return the dataframe with columns from the related tasks merged in.
+
+    The shared task lookup table is used unless another is given. Task IDs
+    of the nullable integer type, where some are missing, are matched
+    against an index of the same type.
+    """
+    if lookup_df is None:
+        lookup_df = get_task_lookup_df()
+    lookup_df = lookup_df[columns]
+    if df[on].dtype.name == 'Int64':
+        lookup_df.index = lookup_df.index.astype('Int64')
+    return df.merge(lookup_df, left_on=on, right_index=True, how='left')
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Normalise annotations into a flat table of the fields used by other scripts.
+
+Each annotation is parsed exactly once, as its page is downloaded (see
+`annotation_columns.py`), and the table is materialised once per run so that
+every output built from the same collection can share it.
+"""
+import functools
+
+from get_annotations import get_annotations_df
+from helpers import ANNOTATIONS_URL
+
+
+PLAYBILLS_URL = '{}/annotations/playbills-results/'.format(
+    ANNOTATIONS_URL.rstrip('/'))
+
+
+@functools.lru_cache(maxsize=None)
+def get_normalised_df(url):
+    """Return the normalised annotations for a collection.
+
+    The result is shared by all callers within a run, so it should not be
+    modified in place.
+    """
+    return get_annotations_df(url)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Write output files, such as the In the Spotlight and Convert-a-Card data.
+
+The format is chosen by setting the `LIBCROWDS_OUTPUT_FORMAT` environment
+variable to one of `csv` (the default), `csv.gz`, `csv.zst`, `parquet` or
+`feather`. Compressing with zstd requires zstandard and the columnar formats
+require pyarrow.
+
+Outputs are written a chunk at a time, from a dataframe or an iterable of
+dataframes, to a temporary file that then replaces the output, so a failed
+run never leaves a partial file in place. A manifest recording the number
+of rows and a SHA-256 checksum is saved alongside each output, as
+`<output>.manifest.json`.
+"""
+import io
+import os
+import gzip
+import json
+import datetime
+import pandas
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+from helpers import mkdirs
+from fingerprints import hash_file
+from columnar_cache import get_nested_columns, encode_nested
+
+
+FORMATS = ['csv', 'csv.gz', 'csv.zst', 'parquet', 'feather']
+
+OUTPUT_FORMAT = os.environ.get('LIBCROWDS_OUTPUT_FORMAT', 'csv')
+
+CHUNK_SIZE = 10000
+
+
+def get_output_path(*path_parts, fmt=None):
+    """Return the path to an output, with the extension for its format.
+
+    The path parts are relative to the root of the repository.
+    """
+    fmt = fmt or OUTPUT_FORMAT
+    if fmt not in FORMATS:
+        raise ValueError('Unknown output format: {}'.format(fmt))
+    here = os.path.abspath(os.path.dirname(__file__))
+    name = os.path.splitext(path_parts[-1])[0]
+    fn = '{0}.{1}'.format(name, fmt)
+    return os.path.join(os.path.dirname(here), *path_parts[:-1], fn)
+
+
+def get_manifest_path(path):
+    """Return the path to the manifest for an output."""
+    return '{}.manifest.json'.format(path)
+
+
+def iter_chunks(data):
+    """Yield chunks of rows from a dataframe or an iterable of dataframes."""
+    if not isinstance(data, pandas.DataFrame):
+        for chunk in data:
+            yield chunk
+        return
+
+    yield data.iloc[:CHUNK_SIZE]
+    for start in range(CHUNK_SIZE, len(data), CHUNK_SIZE):
+        yield data.iloc[start:start + CHUNK_SIZE]
+
+
+def open_text(path, fmt):
+    """Open a text file for writing CSV, compressed if required."""
+    if fmt == 'csv.gz':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if fmt == 'csv.zst':
+        if zstandard is None:
+            raise ImportError('The csv.zst output format requires zstandard')
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(writer, encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def write_csv(path, chunks, fmt):
+    """Write chunks of rows to a CSV file and return the rows and columns."""
+    rows = 0
+    columns = None
+    with open_text(path, fmt) as f:
+        for chunk in chunks:
+            chunk.to_csv(f, index=False, header=columns is None)
+            if columns is None:
+                columns = chunk.columns.tolist()
+            rows += len(chunk)
+    return rows, columns
+
+
+def get_arrow_schema(table):
+    """Return the schema of a table, storing columns of nulls as strings.
+
+    Columns containing only nulls in the first chunk may not in later ones.
+    """
+    fields = [pyarrow.field(field.name, pyarrow.string())
+              if field.type == pyarrow.null() else field
+              for field in table.schema]
+    return pyarrow.schema(fields, metadata=table.schema.metadata)
+
+
+def write_arrow(path, chunks, fmt):
+    """Write chunks of rows to a Parquet or Feather file.
+
+    Columns containing lists or dicts are JSON encoded. Returns the number of
+    rows and the columns written.
+    """
+    if pyarrow is None:
+        raise ImportError('The {} output format requires pyarrow'.format(fmt))
+    rows = 0
+    columns = None
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                columns = chunk.columns.tolist()
+                nested = get_nested_columns(chunk)
+                table = pyarrow.Table.from_pandas(
+                    encode_nested(chunk, nested), preserve_index=False
+                )
+                schema = get_arrow_schema(table)
+                if fmt == 'parquet':
+                    writer = pq.ParquetWriter(path, schema)
+                else:
+                    writer = pyarrow.ipc.new_file(path, schema)
+            table = pyarrow.Table.from_pandas(encode_nested(chunk, nested),
+                                              schema=schema,
+                                              preserve_index=False)
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows, columns
+
+
+def save_manifest(path, manifest):
+    """Save the manifest for an output."""
+    manifest_path = get_manifest_path(path)
+    tmp_path = '{}.tmp'.format(manifest_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def write_output(data, *path_parts, fmt=None):
+    """Save a dataframe, or an iterable of dataframes, to an output file.
+
+    Returns the path to the output.
+    """
+    fmt = fmt or OUTPUT_FORMAT
+    out_path = get_output_path(*path_parts, fmt=fmt)
+    mkdirs(os.path.dirname(out_path))
+    tmp_path = '{}.tmp'.format(out_path)
+    try:
+        if fmt in ['parquet', 'feather']:
+            rows, columns = write_arrow(tmp_path, iter_chunks(data), fmt)
+        else:
+            rows, columns = write_csv(tmp_path, iter_chunks(data), fmt)
+        manifest = {
+            'file': os.path.basename(out_path),
+            'format': fmt,
+            'rows': rows,
+            'columns': columns or [],
+            'bytes': os.path.getsize(tmp_path),
+            'sha256': hash_file(tmp_path, 'sha256'),
+            'created': datetime.datetime.utcnow().isoformat()
+        }
+        os.replace(tmp_path, out_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    save_manifest(out_path, manifest)
+    print('Output saved to {}'.format(out_path))
+    return out_path
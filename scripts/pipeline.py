@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Run a graph of pipeline stages, such as those used to generate the
+In the Spotlight and Convert-a-Card data.
+
+Each stage declares the stages it takes as input. Stages are run
+concurrently once their inputs are available and the upstream results are
+passed along, rather than fetched again. The fingerprint of each stage's
+result is stored, so that an output whose inputs have not changed since
+its last successful run is skipped. Each stage is recorded (see
+`instrument.py`), so that a report of the run can be saved.
+"""
+import os
+import pickle
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas
+
+import instrument
+from output import write_output, get_output_path
+from deltas import write_delta
+from fingerprints import hash_rows
+from helpers import CACHE
+
+
+class Stage(object):
+    """A stage in the pipeline.
+
+    The function is called with the results of the input stages, in order.
+    If output path parts are given the result is saved to that file. If a
+    key column is given the changes to the output can also be exported.
+    Increment the version when the way the stage builds its result changes,
+    so that it is run again even if its inputs have not changed.
+    """
+
+    def __init__(self, name, func, inputs=(), output=None, key=None,
+                 version=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.output = output
+        self.key = key
+        self.version = version
+
+    @property
+    def output_path(self):
+        """Return the path to the output file, in the chosen format."""
+        return get_output_path(*self.output)
+
+
+def get_fingerprint(value):
+    """Return a fingerprint of a stage's result."""
+    sha1 = hashlib.sha1()
+    if isinstance(value, pandas.DataFrame):
+        sha1.update(repr(value.columns.tolist()).encode('utf-8'))
+        hashes = hash_rows(value, index=True)
+        sha1.update(hashes.values.tobytes())
+    else:
+        sha1.update(pickle.dumps(value))
+    return sha1.hexdigest()
+
+
+def count_rows(*values):
+    """Return the total rows of any dataframes in some stage values."""
+    rows = [len(v) for v in values if isinstance(v, pandas.DataFrame)]
+    return sum(rows) if rows else None
+
+
+def get_required_stages(stages, targets):
+    """Return the names of the targets and all of their inputs."""
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending += stages[name].inputs
+    return required
+
+
+class PipelineRun(object):
+    """A single run of some stages in the pipeline."""
+
+    def __init__(self, stages, targets=None, force=False, delta=False,
+                 profile_stage=None):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        targets = targets or [s.name for s in stages if s.output]
+        self.required = get_required_stages(self.stages, targets)
+        self.force = force
+        self.delta = delta
+        self.profile_stage = profile_stage
+        self.values = {}
+        self.fingerprints = {}
+        self.skipped = []
+        self.locks = dict((name, threading.Lock()) for name in self.stages)
+
+    def get_value(self, name):
+        """Return the result of a stage, running it if not yet run."""
+        with self.locks[name]:
+            if name not in self.values:
+                stage = self.stages[name]
+                args = [self.get_value(i) for i in stage.inputs]
+                with instrument.stage(name, rows_in=count_rows(*args),
+                                      profile=name == self.profile_stage
+                                      ) as record:
+                    self.values[name] = stage.func(*args)
+                    record['rows_out'] = count_rows(self.values[name])
+            return self.values[name]
+
+    def resolve(self, name):
+        """Run a stage, or skip it if its inputs and version have not changed.
+
+        Stages exporting their changes are always run, so that the previous
+        changes are not left in place.
+        """
+        stage = self.stages[name]
+        key = ('pipeline', name)
+        input_fps = [self.fingerprints[i] for i in stage.inputs]
+        stored = CACHE.get(key)
+        exporting_delta = self.delta and stage.key
+        if (stage.output and stage.inputs and not self.force and stored and
+                not exporting_delta and stored['inputs'] == input_fps and
+                stored.get('version') == stage.version and
+                os.path.exists(stage.output_path)):
+            self.skipped.append(name)
+            self.fingerprints[name] = stored['output']
+            instrument.add_record(name, skipped=True)
+            return
+
+        value = self.get_value(name)
+        if stage.output:
+            with instrument.stage('{}:output'.format(name),
+                                  rows_in=count_rows(value)):
+                write_output(value, *stage.output)
+                if exporting_delta:
+                    write_delta(value, stage.key, *stage.output)
+        self.fingerprints[name] = get_fingerprint(value)
+        CACHE.set(key, {
+            'inputs': input_fps,
+            'version': stage.version,
+            'output': self.fingerprints[name]
+        }, tag='pipeline')
+
+    def run(self, jobs=1):
+        """Run the required stages, with up to `jobs` at once."""
+        pending = set(self.required)
+        running = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                ready = [name for name in pending
+                         if all(i in self.fingerprints
+                                for i in self.stages[name].inputs)]
+                for name in sorted(ready):
+                    pending.remove(name)
+                    future = executor.submit(self.resolve, name)
+                    running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    future.result()
+        for name in self.skipped:
+            print('Skipped {} as its inputs have not changed'.format(name))
+        return self.values
+
+
+def run_pipeline(stages, targets=None, jobs=1, force=False, delta=False,
+                 profile_stage=None):
+    """Run the targets, and their inputs, from a list of stages.
+
+    If `delta` is True the changes to outputs with a key are also exported.
+    If a profile stage is named it is run under cProfile.
+    """
+    run = PipelineRun(stages, targets, force, delta, profile_stage)
+    return run.run(jobs)
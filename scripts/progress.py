@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Progress bars for downloads, which can share one bar when run at the same
+time.
+
+Each download creates a `Progress`, which shows its own bar. Within a
+`shared_progress` block every download adds to a single bar instead, so
+that batch runs show the aggregate progress.
+
+```python
+with shared_progress('Downloading'):
+    ...
+```
+"""
+import tqdm
+import threading
+import contextlib
+
+
+_shared = None
+
+_lock = threading.Lock()
+
+
+class Progress(object):
+    """The progress of a download, shown on its own bar or the shared one."""
+
+    def __init__(self, desc, unit, total=None):
+        self.is_shared = _shared is not None
+        if self.is_shared:
+            self.bar = _shared
+            self.add_total(total)
+        else:
+            self.bar = tqdm.tqdm(desc=desc, unit=unit, total=total)
+
+    def add_total(self, n):
+        """Add to the total expected, if known."""
+        if not n:
+            return
+        with _lock:
+            self.bar.total = (self.bar.total or 0) + n
+            self.bar.refresh()
+
+    def update(self, n):
+        """Add to the number of items downloaded."""
+        with _lock:
+            self.bar.update(n)
+
+    def close(self):
+        """Close the bar, unless it is shared."""
+        if not self.is_shared:
+            self.bar.close()
+
+
+@contextlib.contextmanager
+def shared_progress(desc, unit='item'):
+    """Show the progress of all downloads started within on one bar."""
+    global _shared
+    _shared = tqdm.tqdm(desc=desc, unit=unit)
+    try:
+        yield _shared
+    finally:
+        _shared.close()
+        _shared = None
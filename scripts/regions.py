@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+A spatial index of the regions of each canvas targeted by annotations.
+
+The fragment selector of each annotation is parsed into a box, and the boxes
+are saved as arrays, grouped by canvas and sorted by their top edge. The
+arrays are loaded through memory mapping, so only the parts read by a query
+are paged in. A query finds the boxes on a canvas by binary search, then
+checks the few boxes whose top edge is in range.
+
+```
+python scripts/regions.py point <canvas> 100 200
+python scripts/regions.py box <canvas> 0 0 500 300
+python scripts/regions.py overlap <annotation-id>
+```
+
+The index for a collection is rebuilt when the collection changes. Use the
+`--url` option to choose another collection.
+"""
+import os
+import re
+import json
+import click
+import numpy
+import shutil
+import pandas
+
+import instrument
+from fingerprints import is_reliable
+from normalise import get_normalised_df, PLAYBILLS_URL
+from get_annotations import get_collection_fingerprint
+from annotation_columns import get_selector_coords
+from helpers import mkdirs, CACHE
+
+
+# Increment when the arrays saved or their types change
+VERSION = 1
+
+ARRAYS = ['sources', 'offsets', 'max_heights', 'x0', 'y0', 'x1', 'y1',
+          'ids', 'id_order', 'tags']
+
+META_FN = 'meta.json'
+
+
+def get_index_dir(url):
+    """Return the directory containing the region index for a collection."""
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', url).strip('-')
+    return os.path.join(CACHE.directory, 'regions', slug)
+
+
+def load_meta(path):
+    """Return the metadata for a region index, or None if it is missing."""
+    meta_path = os.path.join(path, META_FN)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def encode(values):
+    """Return strings as an array of UTF-8 bytes, which can be mapped."""
+    return numpy.array([v.encode('utf-8') for v in values], dtype=bytes)
+
+
+def get_region_arrays(df):
+    """Return the arrays and tag names of a region index for annotations.
+
+    Annotations with selectors that cannot be parsed are left out.
+    """
+    coords_df = get_selector_coords(df['selector']).astype(float)
+    df = pandas.DataFrame({
+        'id': df['id'].astype(str).values,
+        'tag': df['tag'].values,
+        'source': df['source'].astype(object).values,
+        'x0': coords_df['x'].values,
+        'y0': coords_df['y'].values,
+        'x1': (coords_df['x'] + coords_df['w']).values,
+        'y1': (coords_df['y'] + coords_df['h']).values
+    })
+    df = df.dropna(subset=['source', 'x0', 'y0', 'x1', 'y1'])
+    df = df.sort_values(['source', 'y0'], kind='mergesort')
+    df = df.reset_index(drop=True)
+
+    sources = encode(df['source'].astype(str))
+    unique_sources, starts = numpy.unique(sources, return_index=True)
+    heights = (df['y1'] - df['y0']).values
+    tag_codes, tag_names = pandas.factorize(df['tag'])
+    ids = encode(df['id'])
+    arrays = {
+        'sources': unique_sources,
+        'offsets': numpy.append(starts, len(df)).astype('int64'),
+        'max_heights': (numpy.maximum.reduceat(heights, starts)
+                        if len(df) else numpy.array([], dtype=float)),
+        'ids': ids,
+        'id_order': numpy.argsort(ids, kind='mergesort'),
+        'tags': tag_codes.astype('int16')
+    }
+    for col in ['x0', 'y0', 'x1', 'y1']:
+        arrays[col] = df[col].values.astype('float64')
+    return arrays, [str(tag) for tag in tag_names]
+
+
+def save_index(df, path, fingerprint=None):
+    """Build a region index from annotations and save it to a directory.
+
+    The arrays are written to a temporary directory first, which then
+    replaces any existing index.
+    """
+    arrays, tags = get_region_arrays(df)
+    tmp_path = '{}.tmp'.format(path)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    mkdirs(tmp_path)
+    for name in ARRAYS:
+        numpy.save(os.path.join(tmp_path, '{}.npy'.format(name)),
+                   arrays[name])
+    with open(os.path.join(tmp_path, META_FN), 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'count': len(arrays['ids']),
+            'tags': tags,
+            'fingerprint': fingerprint
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+class RegionIndex(object):
+    """A memory mapped index of the regions targeted by annotations."""
+
+    def __init__(self, path):
+        self.meta = load_meta(path)
+        for name in ARRAYS:
+            array = numpy.load(os.path.join(path, '{}.npy'.format(name)),
+                               mmap_mode='r')
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.meta['count']
+
+    def get_bounds(self, source):
+        """Return the first and last rows for a canvas, and its position."""
+        key = source.encode('utf-8')
+        i = numpy.searchsorted(self.sources, key)
+        if i >= len(self.sources) or self.sources[i] != key:
+            return 0, 0, None
+        return int(self.offsets[i]), int(self.offsets[i + 1]), i
+
+    def query(self, source, x0, y0, x1, y1):
+        """Return the rows of the regions on a canvas that overlap a box.
+
+        Regions that only touch the edge of the box are included.
+        """
+        start, end, i = self.get_bounds(source)
+        if i is None:
+            return numpy.array([], dtype='int64')
+        tops = self.y0[start:end]
+        lo = start + numpy.searchsorted(tops, y0 - self.max_heights[i],
+                                        side='left')
+        hi = start + numpy.searchsorted(tops, y1, side='right')
+        hits = ((self.y1[lo:hi] >= y0) & (self.x0[lo:hi] <= x1) &
+                (self.x1[lo:hi] >= x0))
+        return lo + numpy.flatnonzero(hits)
+
+    def point(self, source, x, y):
+        """Return the rows of the regions on a canvas containing a point."""
+        return self.query(source, x, y, x, y)
+
+    def box(self, source, x, y, w, h):
+        """Return the rows of the regions on a canvas overlapping a box."""
+        return self.query(source, x, y, x + w, y + h)
+
+    def get_row(self, anno_id):
+        """Return the row for an annotation, or None if it is not indexed."""
+        key = anno_id.encode('utf-8')
+        j = numpy.searchsorted(self.ids, key, sorter=self.id_order)
+        if j >= len(self.id_order):
+            return None
+        row = int(self.id_order[j])
+        return row if self.ids[row] == key else None
+
+    def get_source(self, row):
+        """Return the canvas of a row."""
+        i = numpy.searchsorted(self.offsets, row, side='right') - 1
+        return self.sources[i].decode('utf-8')
+
+    def overlapping(self, anno_id):
+        """Return the rows of the other regions overlapping an annotation."""
+        row = self.get_row(anno_id)
+        if row is None:
+            raise KeyError(anno_id)
+        rows = self.query(self.get_source(row), self.x0[row], self.y0[row],
+                          self.x1[row], self.y1[row])
+        return rows[rows != row]
+
+    def to_df(self, rows):
+        """Return a dataframe of the annotations and boxes of some rows."""
+        rows = numpy.asarray(rows, dtype='int64')
+        tags = numpy.array(self.meta['tags'] + [None], dtype=object)
+        return pandas.DataFrame({
+            'id': [v.decode('utf-8') for v in self.ids[rows]],
+            'tag': tags[self.tags[rows]],
+            'source': [self.get_source(row) for row in rows],
+            'x': self.x0[rows],
+            'y': self.y0[rows],
+            'w': self.x1[rows] - self.x0[rows],
+            'h': self.y1[rows] - self.y0[rows]
+        }, columns=['id', 'tag', 'source', 'x', 'y', 'w', 'h'])
+
+
+def get_region_index(url=PLAYBILLS_URL, rebuild=False):
+    """Return the region index for a collection.
+
+    The index is rebuilt if the collection has changed since it was saved.
+    """
+    path = get_index_dir(url)
+    fingerprint = get_collection_fingerprint(url)
+    fingerprint = list(fingerprint) if fingerprint else None
+    meta = load_meta(path)
+    if (not rebuild and meta and meta['version'] == VERSION and
+            is_reliable(fingerprint) and meta['fingerprint'] == fingerprint):
+        instrument.count(cache_hits=1)
+        return RegionIndex(path)
+
+    instrument.count(cache_misses=1)
+    save_index(get_normalised_df(url), path, fingerprint)
+    return RegionIndex(path)
+
+
+def print_rows(index, rows):
+    """Print the annotations and boxes of some rows."""
+    if not len(rows):
+        print('No regions found')
+        return
+    with pandas.option_context('display.max_colwidth', 200,
+                               'display.width', 200):
+        print(index.to_df(rows).to_string(index=False))
+
+
+@click.group()
+@click.option('--url', default=PLAYBILLS_URL, show_default=True,
+              help='The annotation collection to index.')
+@click.option('--rebuild', is_flag=True, default=False,
+              help='Rebuild the index even if the collection is unchanged.')
+@click.pass_context
+def cli(ctx, url, rebuild):
+    ctx.obj = {'url': url, 'rebuild': rebuild}
+
+
+def get_context_index(ctx):
+    """Return the region index for the collection chosen on the command."""
+    return get_region_index(ctx.obj['url'], ctx.obj['rebuild'])
+
+
+@cli.command()
+@click.pass_context
+def build(ctx):
+    """Build the region index for a collection."""
+    index = get_region_index(ctx.obj['url'], rebuild=True)
+    print('Indexed {0} regions on {1} canvases'.format(
+        len(index), len(index.sources)))
+
+
+@cli.command()
+@click.argument('source')
+@click.argument('x', type=float)
+@click.argument('y', type=float)
+@click.pass_context
+def point(ctx, source, x, y):
+    """Find the regions of a canvas containing a point."""
+    index = get_context_index(ctx)
+    print_rows(index, index.point(source, x, y))
+
+
+@cli.command()
+@click.argument('source')
+@click.argument('x', type=float)
+@click.argument('y', type=float)
+@click.argument('w', type=float)
+@click.argument('h', type=float)
+@click.pass_context
+def box(ctx, source, x, y, w, h):
+    """Find the regions of a canvas overlapping a box."""
+    index = get_context_index(ctx)
+    print_rows(index, index.box(source, x, y, w, h))
+
+
+@cli.command()
+@click.argument('anno_id')
+@click.pass_context
+def overlap(ctx, anno_id):
+    """Find the regions overlapping the region of an annotation."""
+    index = get_context_index(ctx)
+    try:
+        rows = index.overlapping(anno_id)
+    except KeyError:
+        raise click.BadParameter('No region indexed for {}'.format(anno_id))
+    print_rows(index, rows)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Build the In the Spotlight outputs from shards of annotations, one for each
+manifest, in parallel worker processes.
+
+Every output built from the annotations is local to a canvas, and so to the
+manifest that it is part of. The synced annotations are split into a shard
+per manifest on disk, which is only done again when the collection changes.
+Small shards are grouped into batches, so that each worker process loads a
+batch at a time and builds its part of an output, and the parts are then
+combined. Memory use in the workers is bounded by the batch size, or the
+largest manifest, rather than the whole collection, and every core is used.
+
+With the columnar cache backend the annotations are read from the store a
+manifest at a time, so the whole collection is never loaded at once.
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas
+
+import instrument
+from fingerprints import hash_rows, is_reliable
+from annotation_columns import compact_df
+from annotation_store import iter_store_manifests
+from get_annotations import sync_annotations, get_collection_fingerprint
+from get_its_performances import build_performances_df
+from get_its_title_index import build_title_index_df
+from get_its_sheets import build_sheets_df
+from helpers import save_pickle, load_pickle, mkdirs, CACHE
+
+
+# Increment when the way shards are written changes
+VERSION = 1
+
+META_FN = 'meta.json'
+
+# The most annotations to load in a worker at once, unless one shard is larger
+BATCH_ROWS = 100000
+
+WORKERS = os.cpu_count() or 1
+
+BUILDERS = {
+    'performances': build_performances_df,
+    'title-index': build_title_index_df,
+    'sheets': build_sheets_df
+}
+
+_pool = None
+
+
+def get_shards_dir(url):
+    """Return the directory containing the shards for a collection."""
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', url).strip('-')
+    return os.path.join(CACHE.directory, 'shards', slug)
+
+
+def load_meta(path):
+    """Return the metadata for some shards, or None if they are missing."""
+    meta_path = os.path.join(path, META_FN)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def get_digest(df):
+    """Return a digest of the rows of a shard."""
+    return hashlib.sha1(hash_rows(df).values.tobytes()).hexdigest()
+
+
+def write_shards(url, path, fingerprint=None):
+    """Split the stored annotations for a collection into shards on disk.
+
+    The shards are written to a temporary directory first, which then
+    replaces any existing shards.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    mkdirs(tmp_path)
+    shards = []
+    for i, (part_of, df) in enumerate(iter_store_manifests(url)):
+        fn = '{:06d}.pkl'.format(i)
+        save_pickle(df.reset_index(drop=True), os.path.join(tmp_path, fn))
+        shards.append({
+            'file': fn,
+            'partOf': part_of,
+            'rows': len(df),
+            'digest': get_digest(df)
+        })
+    with open(os.path.join(tmp_path, META_FN), 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'fingerprint': fingerprint,
+            'shards': shards
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def get_shards(url):
+    """Sync a collection and return the path, rows and digest of each shard.
+
+    The shards are split again if the collection has changed since they
+    were written. The digests change with the rows of each shard, so the
+    result can be used to check if the annotations have changed.
+    """
+    path = get_shards_dir(url)
+    fingerprint = get_collection_fingerprint(url)
+    fingerprint = list(fingerprint) if fingerprint else None
+    meta = load_meta(path)
+    if not (meta and meta['version'] == VERSION and
+            is_reliable(fingerprint) and meta['fingerprint'] == fingerprint):
+        instrument.count(cache_misses=1)
+        sync_annotations(url)
+        write_shards(url, path, fingerprint)
+        meta = load_meta(path)
+    else:
+        instrument.count(cache_hits=1)
+    return [(os.path.join(path, shard['file']), shard['rows'],
+             shard['digest']) for shard in meta['shards']]
+
+
+def get_pool():
+    """Return the shared pool of worker processes, creating it on first use.
+
+    Workers are started afresh, rather than forked, as the pipeline runs
+    stages in threads.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def shutdown_pool():
+    """Shut down the shared pool of worker processes, if it was started."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+@functools.lru_cache(maxsize=4)
+def load_context(path):
+    """Return the other inputs of a builder, loaded once per worker."""
+    return load_pickle(path)
+
+
+def get_batches(shards, workers):
+    """Return the paths of the shards grouped into batches.
+
+    Batches are kept small enough to give each worker some of the shards.
+    """
+    total = sum(rows for _, rows, _ in shards)
+    max_rows = max(1, min(BATCH_ROWS, -(-total // workers)))
+    batches = []
+    batch_rows = 0
+    for shard_path, rows, _ in shards:
+        if not batches or batch_rows + rows > max_rows:
+            batches.append([])
+            batch_rows = 0
+        batches[-1].append(shard_path)
+        batch_rows += rows
+    return batches
+
+
+def build_batch(name, shard_paths, context_path):
+    """Return the part of an output built from a batch of shards."""
+    dfs = [load_pickle(shard_path) for shard_path in shard_paths]
+    df = compact_df(pandas.concat(dfs, ignore_index=True, sort=False))
+    return BUILDERS[name](df, *load_context(context_path))
+
+
+def combine_parts(name, parts):
+    """Return an output combined from the parts built from each batch.
+
+    Rows are sorted as they would be if built from the whole collection.
+    """
+    parts = [part for part in parts if not part.empty] or parts[:1]
+    if not parts:
+        return pandas.DataFrame()
+    df = pandas.concat(parts, ignore_index=True, sort=False)
+    if name == 'sheets':
+        df = df.sort_values('id', kind='mergesort').reset_index(drop=True)
+        return df[sorted(df.columns)]
+    if name == 'title-index':
+        return df.sort_values('canvas-ark', kind='mergesort').reset_index(
+            drop=True)
+    return df.sort_values('source', kind='mergesort').reset_index(drop=True)
+
+
+def build_sharded_df(name, shards, *context):
+    """Build an output from batches of shards in the worker processes.
+
+    Any other inputs of the builder, such as the volume metadata, are passed
+    to the workers through a temporary file.
+    """
+    fd, context_path = tempfile.mkstemp(suffix='.pkl')
+    os.close(fd)
+    try:
+        save_pickle(context, context_path)
+        batches = get_batches(shards, WORKERS)
+        parts = get_pool().map(build_batch, [name] * len(batches), batches,
+                               [context_path] * len(batches))
+        return combine_parts(name, list(parts))
+    finally:
+        os.remove(context_path)
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""
+Run a local stand-in for the LibCrowds annotation and PYBOSSA servers. This
+is used to test and benchmark the scripts in this repository without
+touching the live services.
+
+Annotations are served as W3C annotation container pages, along with a
+search endpoint that supports `range` queries on the created and modified
+timestamps. PYBOSSA domain objects are served from `/api/<domain_object>`,
+paged by offset or by `last_id`. Each response can be delayed, to simulate
+network latency, and rate limit headers are sent if a rate limit is set.
+
+```
+python scripts/stand_in_server.py serve --n-annotations 10000 --latency 0.05
+```
+
+Point the scripts at the stand-in server by setting the environment variables
+below (see `helpers.py`).
+
+```bash
+export LIBCROWDS_ANNOTATIONS_URL=http://localhost:8000
+export LIBCROWDS_PYBOSSA_URL=http://localhost:8000
+```
+
+By default synthetic data is served. To serve data recorded from the live
+services instead, record some fixtures then pass their directory to the
+`--fixtures` option.
+
+```
+python scripts/stand_in_server.py record fixtures --max-items 1000
+python scripts/stand_in_server.py serve --fixtures fixtures
+```
+"""
+import os
+import json
+import time
+import click
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from get_annotations import get_annotations
+from get_pybossa_objects import get_objects
+from helpers import mkdirs, ANNOTATIONS_URL
+
+
+MANIFEST_URI = ('https://api.bl.uk/metadata/iiif/ark:/81055/'
+                'vdc_100022588857.0x000002/manifest.json')
+
+CANVAS_URI = 'https://api.bl.uk/metadata/iiif/ark:/81055/vdc_{0}/canvas/{0}'
+
+EPOCH = datetime.datetime(2018, 1, 1)
+
+RANGE_OPERATORS = {
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b
+}
+
+PYBOSSA_PARAMS = ['offset', 'limit', 'last_id', 'orderby', 'desc', 'all',
+                  'api_key']
+
+PYBOSSA_MAX_LIMIT = 100
+
+
+def get_timestamp(seconds):
+    """Return an ISO 8601 timestamp some seconds after the epoch."""
+    dt = EPOCH + datetime.timedelta(seconds=seconds)
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_selector(i):
+    """Return the fragment selector for a synthetic annotation or task."""
+    return '?xywh={0},{1},100,20'.format(i % 7 * 10, i % 30)
+
+
+def make_annotation(i, base_url='http://localhost:8000',
+                    collection='playbills-results',
+                    pybossa_url='https://backend.libcrowds.com'):
+    """Return a synthetic annotation."""
+    tag = ['title', 'date', 'genre'][i % 3]
+    return {
+        'id': '{0}/annotations/{1}/{2}'.format(base_url, collection, i),
+        'type': 'Annotation',
+        'motivation': 'describing',
+        'created': get_timestamp(i),
+        'partOf': MANIFEST_URI,
+        'body': [
+            {
+                'type': 'TextualBody',
+                'purpose': 'describing',
+                'value': '{0} {1}'.format(tag, i),
+                'format': 'text/plain'
+            },
+            {
+                'type': 'TextualBody',
+                'purpose': 'tagging',
+                'value': tag
+            }
+        ],
+        'target': {
+            'source': CANVAS_URI.format(i // 30),
+            'selector': {
+                'conformsTo': 'http://www.w3.org/TR/media-frags/',
+                'type': 'FragmentSelector',
+                'value': get_selector(i)
+            }
+        },
+        'generator': [
+            {
+                'id': 'https://github.com/LibCrowds/libcrowds',
+                'type': 'Software',
+                'name': 'LibCrowds'
+            },
+            {
+                'id': '{0}/api/task/{1}'.format(pybossa_url, i),
+                'type': 'Software'
+            }
+        ]
+    }
+
+
+def make_project(i):
+    """Return a synthetic PYBOSSA project."""
+    return {
+        'id': i,
+        'name': 'Project {}'.format(i),
+        'short_name': 'project-{}'.format(i),
+        'info': {}
+    }
+
+
+def make_task(i, n_projects=3):
+    """Return a synthetic PYBOSSA task, for the annotation with the same ID.
+
+    The tasks for each canvas belong to the same project.
+    """
+    return {
+        'id': i,
+        'project_id': i // 30 % n_projects + 1,
+        'state': 'completed',
+        'n_answers': 3,
+        'info': {
+            'link': 'http://access.bl.uk/item/viewer/{}'.format(i // 30),
+            'target': {
+                'source': CANVAS_URI.format(i // 30),
+                'selector': {
+                    'conformsTo': 'http://www.w3.org/TR/media-frags/',
+                    'type': 'FragmentSelector',
+                    'value': get_selector(i)
+                }
+            }
+        }
+    }
+
+
+def load_fixtures(path):
+    """Return the annotations and PYBOSSA objects recorded to a directory.
+
+    Annotations are loaded from `annotations/<collection>.json` and PYBOSSA
+    objects from `pybossa/<domain_object>.json`.
+    """
+    fixtures = {}
+    for kind in ['annotations', 'pybossa']:
+        fixtures[kind] = {}
+        kind_dir = os.path.join(path, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for fn in sorted(os.listdir(kind_dir)):
+            name, ext = os.path.splitext(fn)
+            if ext == '.json':
+                with open(os.path.join(kind_dir, fn)) as f:
+                    fixtures[kind][name] = json.load(f)
+    return fixtures['annotations'], fixtures['pybossa']
+
+
+def save_fixture(path, kind, name, items):
+    """Save a list of recorded items to a fixtures directory."""
+    kind_dir = os.path.join(path, kind)
+    mkdirs(kind_dir)
+    with open(os.path.join(kind_dir, '{}.json'.format(name)), 'w') as f:
+        json.dump(items, f)
+
+
+def record_annotations(url, max_items):
+    """Return up to a maximum number of annotations from a collection."""
+    items = []
+    page = 0
+    r = get_annotations(url, page)
+    while r and len(items) < max_items:
+        last_fetched = r.json()['items']
+        if not last_fetched:
+            break
+        items += last_fetched
+        page += 1
+        r = get_annotations(url, page)
+    return items[:max_items]
+
+
+def record_pybossa_objects(obj, max_items):
+    """Return up to a maximum number of PYBOSSA domain objects."""
+    items = []
+    while len(items) < max_items:
+        last_fetched = get_objects(obj, len(items)).json()
+        if not last_fetched:
+            break
+        items += last_fetched
+    return items[:max_items]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve annotations and PYBOSSA objects from the server's data."""
+
+    def log_message(self, format, *args):
+        """Keep the benchmark output clean."""
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        """Send a JSON response."""
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/ld+json')
+        self.send_header('Content-Length', str(len(body)))
+        headers = dict(self.rate_limit_headers, **(headers or {}))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, page_id, items, page):
+        """Send a page of annotations, or a 404 if it is out of range."""
+        per_page = self.server.per_page
+        start = page * per_page
+        if page < 0 or (start >= len(items) and page > 0):
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_json({
+            'id': page_id,
+            'type': 'AnnotationPage',
+            'startIndex': start,
+            'items': items[start:start + per_page]
+        })
+
+    def do_GET(self):
+        """Return annotations, search results or PYBOSSA objects."""
+        time.sleep(self.server.latency)
+        allowed, self.rate_limit_headers = self.server.check_rate_limit()
+        if not allowed:
+            return self.send_json({
+                'status': 'failed',
+                'status_code': 429,
+                'exception_msg': 'Rate limit exceeded'
+            }, 429)
+
+        parsed = urlparse(self.path)
+        parts = [p for p in parsed.path.split('/') if p]
+        query = parse_qs(parsed.query)
+        page = int(query.get('page', [0])[0])
+        if parts == ['search']:
+            return self.do_search(query, page)
+        if len(parts) == 2 and parts[0] == 'api':
+            return self.do_api(parts[1], query)
+        if len(parts) != 2 or parts[0] != 'annotations':
+            return self.send_json({'message': 'Not Found'}, 404)
+
+        items = self.server.get_annotations(parts[1])
+        per_page = self.server.per_page
+        container = '{0}/annotations/{1}/'.format(self.server.base_url,
+                                                  parts[1])
+        if 'page' not in query:
+            last = max(0, (len(items) - 1) // per_page)
+            return self.send_json({
+                'id': container,
+                'type': ['BasicContainer', 'AnnotationCollection'],
+                'total': len(items),
+                'first': '{}?page=0'.format(container),
+                'last': '{0}?page={1}'.format(container, last)
+            }, headers={'ETag': '"{}"'.format(self.server.version)})
+
+        self.send_page('{0}?page={1}'.format(container, page), items, page)
+
+    def do_search(self, query, page):
+        """Return a page of annotations matching a range query."""
+        collection = query.get('collection', [''])[0]
+        name = [p for p in urlparse(collection).path.split('/') if p][-1:]
+        items = self.server.get_annotations(name[0] if name else None)
+        ranges = json.loads(query.get('range', ['{}'])[0])
+        for field, conditions in ranges.items():
+            for op, value in conditions.items():
+                items = [item for item in items if field in item and
+                         RANGE_OPERATORS[op](item[field], value)]
+        search_url = '{}/search/'.format(self.server.base_url)
+        self.send_page('{0}?page={1}'.format(search_url, page), items, page)
+
+    def do_api(self, obj, query):
+        """Return a list of PYBOSSA domain objects.
+
+        Objects can be filtered by any top-level field and are paged by ID,
+        if a `last_id` is given, otherwise by offset.
+        """
+        if obj not in self.server.objects:
+            return self.send_json({
+                'status': 'failed',
+                'status_code': 404,
+                'exception_msg': 'Not Found'
+            }, 404)
+        params = dict((key, values[0]) for key, values in query.items())
+        limit = min(int(params.get('limit', 20)), PYBOSSA_MAX_LIMIT)
+        offset = int(params.get('offset', 0))
+        last_id = int(params.get('last_id', 0))
+        items = self.server.objects[obj]
+        for key, value in params.items():
+            if key not in PYBOSSA_PARAMS:
+                items = [item for item in items
+                         if str(item.get(key)) == value]
+        if params.get('orderby'):
+            reverse = params.get('desc', '').lower() == 'true'
+            items = sorted(items, key=lambda item: item[params['orderby']],
+                           reverse=reverse)
+        if last_id:
+            items = [item for item in items if item['id'] > last_id]
+            offset = 0
+        self.send_json(items[offset:offset + limit])
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server holding the stand-in data.
+
+    If a rate limit is given, no more than that number of requests are
+    allowed in each window of `rate_window` seconds.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, n_annotations=1000, per_page=100,
+                 latency=0, n_projects=3, rate_limit=None, rate_window=900,
+                 fixtures=None):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.base_url = 'http://{0}:{1}'.format(*self.server_address)
+        self.per_page = per_page
+        self.latency = latency
+        self.n_projects = n_projects
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.rate_lock = threading.Lock()
+        self.window_reset = time.time() + rate_window
+        self.window_requests = 0
+        self.version = 0
+        self.collections = {}
+        self.annotations = []
+        self.objects = {
+            'project': [make_project(i) for i in range(1, n_projects + 1)],
+            'task': []
+        }
+        if fixtures:
+            self.collections, objects = load_fixtures(fixtures)
+            self.objects.update(objects)
+        else:
+            self.add_annotations(n_annotations)
+
+    def get_annotations(self, collection):
+        """Return the annotations in a collection."""
+        return self.collections.get(collection, self.annotations)
+
+    def check_rate_limit(self):
+        """Count a request and return if it is allowed, with the headers."""
+        if not self.rate_limit:
+            return True, {}
+        with self.rate_lock:
+            now = time.time()
+            if now >= self.window_reset:
+                self.window_reset = now + self.rate_window
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = max(0, self.rate_limit - self.window_requests)
+            allowed = self.window_requests <= self.rate_limit
+            return allowed, {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(int(self.window_reset))
+            }
+
+    def add_annotations(self, n):
+        """Add some new annotations to the collection, and their tasks."""
+        start = len(self.annotations)
+        self.annotations += [make_annotation(i, self.base_url,
+                                             pybossa_url=self.base_url)
+                             for i in range(start, start + n)]
+        self.objects['task'] += [make_task(i, self.n_projects)
+                                 for i in range(start, start + n)]
+        self.version += 1
+
+    def modify_annotations(self, indexes):
+        """Mark some of the annotations as modified just now."""
+        seconds = len(self.annotations) + 1
+        for i in indexes:
+            anno = dict(self.annotations[i], modified=get_timestamp(seconds))
+            anno['body'] = [dict(b) for b in anno['body']]
+            anno['body'][0]['value'] += ' (modified)'
+            self.annotations[i] = anno
+        self.version += 1
+
+
+def start_server(port=0, **kwargs):
+    """Start a stand-in server in a background thread and return it."""
+    server = StandInServer(('127.0.0.1', port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--port', default=8000, show_default=True)
+@click.option('--n-annotations', default=1000, show_default=True)
+@click.option('--per-page', default=100, show_default=True)
+@click.option('--n-projects', default=3, show_default=True)
+@click.option('--latency', default=0.0, show_default=True,
+              help='Seconds to wait before each response.')
+@click.option('--rate-limit', default=None, type=int,
+              help='Maximum requests in each rate limit window.')
+@click.option('--rate-window', default=900, show_default=True,
+              help='Seconds in each rate limit window.')
+@click.option('--fixtures', default=None, type=click.Path(exists=True),
+              help='Serve the data recorded to this directory.')
+def serve(port, n_annotations, per_page, n_projects, latency, rate_limit,
+          rate_window, fixtures):
+    """Serve the stand-in data."""
+    server = StandInServer(('127.0.0.1', port), n_annotations=n_annotations,
+                           per_page=per_page, latency=latency,
+                           n_projects=n_projects, rate_limit=rate_limit,
+                           rate_window=rate_window, fixtures=fixtures)
+    print('Serving on {}'.format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+@cli.command()
+@click.argument('path', type=click.Path())
+@click.option('--collection', '-c', multiple=True,
+              default=['playbills-results', 'convert-a-card-results'],
+              show_default=True)
+@click.option('--object', '-o', 'objects', multiple=True,
+              default=['project', 'task'], show_default=True)
+@click.option('--max-items', default=1000, show_default=True,
+              help='Maximum items to record for each collection or object.')
+def record(path, collection, objects, max_items):
+    """Record fixtures from the live services."""
+    for name in collection:
+        url = '{0}/annotations/{1}/'.format(ANNOTATIONS_URL, name)
+        items = record_annotations(url, max_items)
+        save_fixture(path, 'annotations', name, items)
+        print('Recorded {0} annotations from {1}'.format(len(items), name))
+    for obj in objects:
+        items = record_pybossa_objects(obj, max_items)
+        save_fixture(path, 'pybossa', obj, items)
+        print('Recorded {0} {1} objects'.format(len(items), obj))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Generate synthetic In the Spotlight and Convert-a-Card data at any size.
+
+The generated tables have the same columns as the normalised annotations
+(see `annotation_columns.py`), the PYBOSSA task mirror and project tables,
+so they can be passed straight to the functions that build each output.
+Annotations are returned in the compact form loaded from the local store.
+Each generator takes a seed, so the same data is produced every time.
+"""
+import os
+import numpy
+import pandas
+from pymarc import Record, Field
+try:
+    from pymarc import Subfield
+except ImportError:
+    Subfield = None
+
+from annotation_columns import COLUMNS, compact_df
+from helpers import mkdirs, get_lark
+
+
+CANVAS_PREFIX = 'https://api.bl.uk/metadata/iiif/ark:/81055/vdc_'
+
+GENRES = ['Comedy', 'Tragedy', 'Farce', 'Opera', 'Pantomime', 'Melodrama',
+          'Burletta', 'Ballet']
+
+LANGUAGES = ['chi', 'ind', 'jpn', 'kor', 'eng']
+
+# Each playbill lists this many performances, each tagged with a title, a
+# date and a genre
+PERFORMANCES_PER_CANVAS = 3
+
+
+def _join(*parts):
+    """Concatenate string series and scalars element-wise."""
+    out = None
+    for part in parts:
+        if isinstance(part, pandas.Series):
+            part = part.astype(str)
+        out = part if out is None else out + part
+    return out
+
+
+def _choice(rng, values, n):
+    """Return a series of values chosen at random."""
+    return pandas.Series(numpy.asarray(values, dtype=object)[
+        rng.randint(len(values), size=n)
+    ])
+
+
+def make_dates(rng, n, incomplete=0.1):
+    """Return a series of ISO dates, some with only the year."""
+    years = pandas.Series(rng.randint(1737, 1950, size=n)).astype(str)
+    months = pandas.Series(rng.randint(1, 13, size=n)).astype(str).str.zfill(2)
+    days = pandas.Series(rng.randint(1, 29, size=n)).astype(str).str.zfill(2)
+    dates = _join(years, '-', months, '-', days)
+    return dates.where(rng.rand(n) >= incomplete, years)
+
+
+def make_selectors(x, y, w, h):
+    """Return a series of fragment selector coordinates.
+
+    The width and height can be given for all selectors.
+    """
+    x, y, w, h = [pandas.Series(numpy.broadcast_to(v, len(x)))
+                  for v in (x, y, w, h)]
+    return _join(x, ',', y, ',', w, ',', h)
+
+
+def make_its_annotations_df(n, manifest_uris, seed=0):
+    """Return about `n` normalised In the Spotlight annotations.
+
+    Each performance is given a title, date and genre annotation. The genre
+    is marked on the same fragment as the title, and the dates below it.
+    """
+    rng = numpy.random.RandomState(seed)
+    n_perf = max(1, n // 3)
+    perf = numpy.arange(n_perf)
+    canvas = perf // PERFORMANCES_PER_CANVAS
+    n_canvas = canvas[-1] + 1
+    volumes = numpy.asarray(manifest_uris, dtype=object)[
+        rng.randint(len(manifest_uris), size=n_canvas)
+    ]
+    sources = _join(CANVAS_PREFIX, pandas.Series(100000000000 + canvas),
+                    '.0x000001')
+
+    x = rng.randint(0, 1500, size=n_perf)
+    y = perf % PERFORMANCES_PER_CANVAS * 400 + rng.randint(0, 50, size=n_perf)
+    title_selectors = make_selectors(x, y, 800, 100)
+    date_selectors = make_selectors(x, y + 150, 400, 60)
+
+    titles = _join('Title ', pandas.Series(rng.randint(0, max(1, n_perf // 4),
+                                                       size=n_perf)))
+    parts = []
+    for i, (tag, values, selectors) in enumerate([
+        ('title', titles, title_selectors),
+        ('date', make_dates(rng, n_perf), date_selectors),
+        ('genre', _choice(rng, GENRES, n_perf), title_selectors)
+    ]):
+        parts.append(pandas.DataFrame({
+            'tag': tag,
+            'transcription': values.values,
+            'source': sources.values,
+            'selector': selectors.values,
+            'partOf': volumes[canvas],
+            'task_id': perf * 3 + i + 1
+        }))
+    df = pandas.concat(parts, ignore_index=True)
+    df = df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+
+    df['id'] = _join('https://annotations.libcrowds.com/annotations/'
+                     'playbills-results/', df['task_id'])
+    df['created'] = '2018-01-01T00:00:00Z'
+    df['modified'] = None
+    df['motivation'] = 'describing'
+    lark_lookup = dict((uri, get_lark(uri)) for uri in manifest_uris)
+    df['lark'] = df['partOf'].map(lark_lookup)
+    return compact_df(df[COLUMNS])
+
+
+def make_pybossa_dfs(annotations_df, seed=0):
+    """Return the task mirror and project tables for some annotations.
+
+    There is a task for each annotation, targeting the same fragment, and a
+    project for each volume.
+    """
+    rng = numpy.random.RandomState(seed)
+    tasks_df = annotations_df[['task_id', 'source', 'selector', 'partOf']]
+    tasks_df = tasks_df.drop_duplicates('task_id').set_index('task_id')
+    tasks_df.index.name = 'id'
+    volumes = tasks_df['partOf'].unique()
+    project_ids = pandas.Series(numpy.arange(1, len(volumes) + 1),
+                                index=volumes)
+    out_df = pandas.DataFrame({
+        'info.link': _join('http://access.bl.uk/item/viewer/',
+                           tasks_df['source'].str.split('vdc_').str[-1]),
+        'info.target.selector.value': _join('?xywh=', tasks_df['selector']),
+        'project_id': tasks_df['partOf'].map(project_ids)
+    }, index=tasks_df.index)
+    projects_df = pandas.DataFrame({
+        'name': _join('Project ', pandas.Series(project_ids.values)).values,
+        'n_tasks': rng.randint(100, 1000, size=len(project_ids))
+    }, index=pandas.Index(project_ids.values, name='id'))
+    return out_df, projects_df
+
+
+def make_shelfmarks(rng, n):
+    """Return a series of shelfmarks, some needing to be tidied."""
+    prefixes = _choice(rng, ['ORB.30/', 'ORB.40/', 'chi.', 'CHI.', '15298.'],
+                       n)
+    shelfmarks = _join(prefixes, pandas.Series(numpy.arange(n)))
+    unclosed = rng.rand(n) < 0.05
+    return shelfmarks.where(~unclosed, shelfmarks + ' (v.1')
+
+
+def make_cac_annotations_df(n, seed=0):
+    """Return about `n` normalised Convert-a-Card annotations.
+
+    Each task is given a shelfmark reference and a WorldCat control number.
+    """
+    rng = numpy.random.RandomState(seed)
+    n_tasks = max(1, n // 2)
+    task_ids = numpy.arange(1, n_tasks + 1)
+    references = make_shelfmarks(rng, n_tasks)
+    control_numbers = pandas.Series(rng.randint(10 ** 6, 10 ** 9,
+                                                size=n_tasks)).astype(str)
+    sources = _join('https://api.bl.uk/image/iiif/ark:/81055/vdc_card_',
+                    pandas.Series(task_ids))
+    parts = []
+    for tag, values in [('reference', references),
+                        ('control_number', control_numbers)]:
+        parts.append(pandas.DataFrame({
+            'tag': tag,
+            'transcription': values.values,
+            'source': sources.values,
+            'task_id': task_ids
+        }))
+    df = pandas.concat(parts, ignore_index=True)
+    df['id'] = _join('https://annotations.libcrowds.com/annotations/'
+                     'convert-a-card-results/', pandas.Series(df.index))
+    df['created'] = '2018-01-01T00:00:00Z'
+    df['modified'] = None
+    df['motivation'] = 'describing'
+    df['selector'] = '0,0,1000,600'
+    df['partOf'] = _join('https://api.bl.uk/metadata/iiif/ark:/81055/'
+                         'vdc_drawer_', df['task_id'] // 1000,
+                         '.0x000001/manifest.json')
+    df['lark'] = df['partOf'].map(get_lark)
+    return compact_df(df[COLUMNS])
+
+
+def make_marc_record(shelfmark, language):
+    """Return a MARC record with a language code and a shelfmark."""
+    record = Record()
+    record.add_field(Field(tag='008', data=' ' * 35 + language + '  '))
+    if Subfield is None:
+        subfields = ['j', shelfmark]
+    else:
+        subfields = [Subfield('j', shelfmark)]
+    record.add_field(Field(tag='852', indicators=[' ', ' '],
+                           subfields=subfields))
+    return record
+
+
+def write_lex_files(path, shelfmarks, n_files=10, seed=0):
+    """Write MARC records for some shelfmarks to `.lex` files.
+
+    Returns the paths to the files.
+    """
+    rng = numpy.random.RandomState(seed)
+    languages = _choice(rng, LANGUAGES, len(shelfmarks))
+    mkdirs(path)
+    paths = []
+    for i, chunk in enumerate(numpy.array_split(numpy.arange(len(shelfmarks)),
+                                                n_files)):
+        fn_path = os.path.join(path, 'synthetic_{}.lex'.format(i))
+        with open(fn_path, 'wb') as f:
+            for j in chunk:
+                record = make_marc_record(shelfmarks.iloc[j],
+                                          languages.iloc[j])
+                f.write(record.as_marc())
+        paths.append(fn_path)
+    return paths